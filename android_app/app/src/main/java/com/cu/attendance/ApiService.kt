@@ -14,6 +14,17 @@ data class StatsResponse(
 	val remaining: Int
 )
 
+data class RosterResponse(
+	val version: Long,
+	val etag: String,
+	val students: List<StudentEntity>,
+	val removed: List<String>,
+	/** True when [students] only holds rows changed since the requested version. */
+	val isDelta: Boolean,
+	/** True on HTTP 304: the local roster is already at [version]. */
+	val notModified: Boolean
+)
+
 sealed class MarkResult {
 	data class Success(val student: StudentEntity) : MarkResult()
 	data class AlreadyMarked(val student: StudentEntity) : MarkResult()
@@ -103,40 +114,70 @@ object ApiService {
 		}
 	}
 
-	suspend fun fetchRoster(eventId: Long): List<StudentEntity> = withContext(Dispatchers.IO) {
-		try {
-			val request = Request.Builder()
-				.url(ApiClient.url("/api/event/$eventId/roster"))
-				.get()
-				.build()
+	/**
+	 * Fetch the event roster. With a previously synced [sinceVersion]/[etag] the server
+	 * answers 304 when nothing changed, or only the students upserted since that version.
+	 */
+	suspend fun fetchRoster(eventId: Long, sinceVersion: Long = 0L, etag: String = ""): RosterResponse? =
+		withContext(Dispatchers.IO) {
+			try {
+				val builder = Request.Builder()
+					.url(ApiClient.url("/api/event/$eventId/roster?since_version=$sinceVersion"))
+					.get()
+				if (sinceVersion > 0L && etag.isNotEmpty()) builder.header("If-None-Match", etag)
 
-			ApiClient.client.newCall(request).execute().use { response ->
-				val bodyText = response.body?.string().orEmpty()
-				if (!response.isSuccessful) return@withContext emptyList<StudentEntity>()
-				val array = JSONArray(bodyText)
-				return@withContext buildList {
-					for (i in 0 until array.length()) {
-						val item = array.optJSONObject(i) ?: continue
-						add(
-							StudentEntity(
-								eventId = eventId,
-								uid = item.optString("uid", "").trim(),
-								name = item.optString("name", "").trim(),
-								branch = item.optString("branch", "").trim(),
-								year = item.optString("year", "").trim(),
-								status = "Absent",
-								timestamp = ""
-							)
-						)
+				ApiClient.client.newCall(builder.build()).execute().use { response ->
+					val newEtag = response.header("ETag").orEmpty()
+					if (response.code == 304) {
+						return@withContext RosterResponse(sinceVersion, etag, emptyList(), emptyList(), isDelta = true, notModified = true)
 					}
+					val bodyText = response.body?.string().orEmpty()
+					if (!response.isSuccessful) return@withContext null
+					val json = JSONObject(bodyText)
+					val upserted = json.optJSONArray("upserted") ?: JSONArray()
+					val removed = json.optJSONArray("removed") ?: JSONArray()
+					return@withContext RosterResponse(
+						version = json.optLong("version", 0L),
+						etag = newEtag,
+						students = buildList {
+							for (i in 0 until upserted.length()) {
+								val item = upserted.optJSONObject(i) ?: continue
+								add(
+									StudentEntity(
+										eventId = eventId,
+										uid = item.optString("uid", "").trim(),
+										name = item.optString("name", "").trim(),
+										branch = item.optString("branch", "").trim(),
+										year = item.optString("year", "").trim(),
+										status = "Absent",
+										timestamp = ""
+									)
+								)
+							}
+						},
+						removed = buildList {
+							for (i in 0 until removed.length()) add(removed.optString(i))
+						},
+						isDelta = json.optBoolean("delta", false),
+						notModified = false
+					)
 				}
+			} catch (_: Exception) {
+				null
 			}
-		} catch (_: Exception) {
-			emptyList()
 		}
-	}
 
-	suspend fun markAttendance(eventId: Long, uid: String, deviceId: String, deviceTimestamp: String): MarkResult =
+	/**
+	 * [idempotencyKey]: pass a stable key per queued operation so a retry after a lost
+	 * response gets the original result back instead of a 409.
+	 */
+	suspend fun markAttendance(
+		eventId: Long,
+		uid: String,
+		deviceId: String,
+		deviceTimestamp: String,
+		idempotencyKey: String? = null
+	): MarkResult =
 		withContext(Dispatchers.IO) {
 			try {
 				val body = JSONObject()
@@ -150,6 +191,7 @@ object ApiService {
 				val request = Request.Builder()
 					.url(ApiClient.url("/mark"))
 					.post(body)
+					.apply { idempotencyKey?.let { header("Idempotency-Key", it) } }
 					.build()
 
 				ApiClient.client.newCall(request).execute().use { response ->
@@ -201,7 +243,14 @@ object ApiService {
 			}
 		}
 
-	suspend fun addStudent(eventId: Long, uid: String, name: String, branch: String, year: String): MarkResult =
+	suspend fun addStudent(
+		eventId: Long,
+		uid: String,
+		name: String,
+		branch: String,
+		year: String,
+		idempotencyKey: String? = null
+	): MarkResult =
 		withContext(Dispatchers.IO) {
 			try {
 				val payload = JSONObject()
@@ -216,6 +265,7 @@ object ApiService {
 				val request = Request.Builder()
 					.url(ApiClient.url("/add"))
 					.post(payload)
+					.apply { idempotencyKey?.let { header("Idempotency-Key", it) } }
 					.build()
 
 				ApiClient.client.newCall(request).execute().use { response ->
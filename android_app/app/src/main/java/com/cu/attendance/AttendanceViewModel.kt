@@ -71,10 +71,22 @@ class AttendanceViewModel(application: Application) : AndroidViewModel(applicati
             if (eventId == null || eventId <= 0L) return@launch
 
             try {
-                val roster = ApiService.fetchRoster(eventId)
-                if (roster.isEmpty()) return@launch
+                val context = getApplication<Application>()
+                val (syncedVersion, syncedEtag) = EventPrefs.loadRosterVersion(context, eventId)
+                // An emptied local table (e.g. after a reset) always needs the full roster.
+                val hasLocal = withContext(Dispatchers.IO) { database.studentDao().getCount(eventId) > 0 }
+                val response = if (hasLocal) {
+                    ApiService.fetchRoster(eventId, syncedVersion, syncedEtag)
+                } else {
+                    ApiService.fetchRoster(eventId)
+                } ?: return@launch
+                if (response.notModified) return@launch
+                val roster = response.students
 
                 withContext(Dispatchers.IO) {
+                    if (response.removed.isNotEmpty()) {
+                        database.studentDao().deleteByUids(eventId, response.removed)
+                    }
                     val existing = database.studentDao().getAllStudents(eventId)
                     val existingByUid = existing.associateBy { it.uid }
 
@@ -95,6 +107,7 @@ class AttendanceViewModel(application: Application) : AndroidViewModel(applicati
                         database.studentDao().insertAll(merged)
                     }
                 }
+                EventPrefs.saveRosterVersion(context, eventId, response.version, response.etag)
 
                 // Refresh local-based UI (search/stats) after syncing roster.
                 refreshStats()
@@ -231,6 +244,7 @@ class AttendanceViewModel(application: Application) : AndroidViewModel(applicati
 					database.studentDao().deleteAll(eventId)
 					database.offlineQueueDao().clear(eventId)
                 }
+				EventPrefs.clearRosterVersion(getApplication(), eventId)
                 _searchResults.value = emptyList()
                 _stats.value = AttendanceStats()
                 _error.value = null
@@ -6,6 +6,8 @@ object EventPrefs {
 	private const val PREFS = "event_prefs"
 	private const val KEY_ID = "selected_event_id"
 	private const val KEY_NAME = "selected_event_name"
+	private const val KEY_ROSTER_VERSION = "roster_version_"
+	private const val KEY_ROSTER_ETAG = "roster_etag_"
 
 	fun loadSelectedEvent(context: Context): SelectedEvent? {
 		val prefs = context.getSharedPreferences(PREFS, Context.MODE_PRIVATE)
@@ -26,4 +28,26 @@ object EventPrefs {
 			.putString(KEY_NAME, selected.eventName)
 			.apply()
 	}
+
+	/** Roster version/ETag last synced for the event (0 / "" when never synced). */
+	fun loadRosterVersion(context: Context, eventId: Long): Pair<Long, String> {
+		val prefs = context.getSharedPreferences(PREFS, Context.MODE_PRIVATE)
+		return prefs.getLong(KEY_ROSTER_VERSION + eventId, 0L) to prefs.getString(KEY_ROSTER_ETAG + eventId, "").orEmpty()
+	}
+
+	fun saveRosterVersion(context: Context, eventId: Long, version: Long, etag: String) {
+		val prefs = context.getSharedPreferences(PREFS, Context.MODE_PRIVATE)
+		prefs.edit()
+			.putLong(KEY_ROSTER_VERSION + eventId, version)
+			.putString(KEY_ROSTER_ETAG + eventId, etag)
+			.apply()
+	}
+
+	fun clearRosterVersion(context: Context, eventId: Long) {
+		val prefs = context.getSharedPreferences(PREFS, Context.MODE_PRIVATE)
+		prefs.edit()
+			.remove(KEY_ROSTER_VERSION + eventId)
+			.remove(KEY_ROSTER_ETAG + eventId)
+			.apply()
+	}
 }
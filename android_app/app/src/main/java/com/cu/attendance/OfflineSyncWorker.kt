@@ -21,6 +21,8 @@ class OfflineSyncWorker(
 		var shouldRetry = false
 
 		for (item in queue) {
+			// Same key on every retry of this queue item, so the server replays its first answer.
+			val idempotencyKey = "offline-$deviceId-${item.id}"
 			when (item.action) {
 				"MARK_PRESENT" -> {
 					val payload = item.payload.orEmpty()
@@ -28,7 +30,7 @@ class OfflineSyncWorker(
 						if (payload.isBlank()) "" else JSONObject(payload).optString("device_timestamp", "")
 					}.getOrDefault("")
 
-					when (val result = ApiService.markAttendance(item.eventId, item.uid, deviceId, deviceTimestamp)) {
+					when (val result = ApiService.markAttendance(item.eventId, item.uid, deviceId, deviceTimestamp, idempotencyKey)) {
 						is MarkResult.Success -> {
 							// Server confirmed: ensure local row is Present (not Queued).
 							db.studentDao().insert(result.student.copy(eventId = item.eventId, uid = item.uid, status = "Present"))
@@ -59,7 +61,7 @@ class OfflineSyncWorker(
 					val branch = json?.optString("branch", "").orEmpty()
 					val year = json?.optString("year", "").orEmpty()
 
-					when (val result = ApiService.addStudent(item.eventId, item.uid, name, branch, year)) {
+					when (val result = ApiService.addStudent(item.eventId, item.uid, name, branch, year, idempotencyKey)) {
 						is MarkResult.Success,
 						is MarkResult.AlreadyMarked,
 						MarkResult.Invalid -> {
@@ -33,4 +33,7 @@ interface StudentDao {
 
     @Query("DELETE FROM students WHERE eventId = :eventId")
     suspend fun deleteAll(eventId: Long)
+
+    @Query("DELETE FROM students WHERE eventId = :eventId AND uid IN (:uids)")
+    suspend fun deleteByUids(eventId: Long, uids: List<String>)
 }
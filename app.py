@@ -1,17 +1,116 @@
+import atexit
+import cProfile
+import csv
+import gzip
+import hashlib
 import io
+import itertools
+import json
+import logging
 import os
+import queue
+import re
 import secrets
 import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter, OrderedDict
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
-
-import pandas as pd
-from flask import Flask, jsonify, redirect, render_template, request, send_file, session, url_for
+from typing import IO
+
+import click
+import openpyxl
+from flask import (
+    Flask,
+    Response,
+    g,
+    has_request_context,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    stream_with_context,
+    url_for,
+)
 
 
 DB_PATH = os.environ.get("DB_PATH", "attendance.db")
-UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# SQLite connection tuning (applied once per pooled connection).
+SQLITE_JOURNAL_MODE = (os.environ.get("SQLITE_JOURNAL_MODE", "WAL") or "WAL").upper()
+SQLITE_SYNCHRONOUS = (os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL") or "NORMAL").upper()
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000") or "5000")
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "16384") or "16384")
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(128 * 1024 * 1024)) or "0")
+# Events whose roster is cached in memory per worker for scan validation.
+ROSTER_CACHE_EVENTS = int(os.environ.get("ROSTER_CACHE_EVENTS", "8") or "8")
+# /search result cap (clients may ask for fewer with ?limit=).
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", "50") or "50")
+# Live SSE streams: how often each worker checks the database for commits made by other
+# workers, the keepalive comment interval, and how long one stream is held before the
+# browser is asked to reconnect (frees the gunicorn thread).
+STREAM_POLL_SECONDS = float(os.environ.get("STREAM_POLL_SECONDS", "0.25") or "0.25")
+STREAM_KEEPALIVE_SECONDS = float(os.environ.get("STREAM_KEEPALIVE_SECONDS", "15") or "15")
+STREAM_MAX_SECONDS = float(os.environ.get("STREAM_MAX_SECONDS", "300") or "300")
+# Open streams per worker under WSGI, where each one holds a thread for up to
+# STREAM_MAX_SECONDS. Keep it well below gunicorn --threads so scanners always get one;
+# viewers over the cap get a 503 and poll instead. (asgi.py streams don't count.)
+STREAM_MAX_PER_WORKER = int(os.environ.get("STREAM_MAX_PER_WORKER", "4") or "4")
+STREAM_BUSY_RETRY_SECONDS = 30
+# Rows per events_live payload (matches /api/event/<id>/live).
+STREAM_ROWS = 50
+# Per-worker metric snapshots are written here and summed by /metrics (one file per pid).
+METRICS_DIR = os.environ.get("METRICS_DIR") or f"{DB_PATH}-metrics"
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "5") or "5")
+# Opt-in per-request SQL profiling: X-DB-Queries / X-DB-Time-ms response headers, and
+# statements slower than SQL_SLOW_MS logged (parameters redacted) to the
+# "attendance.slow_sql" logger, plus SQL_SLOW_LOG when set.
+SQL_PROFILE = (os.environ.get("SQL_PROFILE", "") or "").strip().lower() in ("1", "true", "yes", "on")
+SQL_SLOW_MS = float(os.environ.get("SQL_SLOW_MS", "50") or "50")
+SQL_SLOW_LOG = os.environ.get("SQL_SLOW_LOG", "")
+# Optional per-event storage: each event's students, attendance, counters and versions live
+# in EVENT_SHARD_DIR/event-<id>.db, attached as schema "event" to a connection on the
+# catalog (DB_PATH: events, sessions, devices, import staging). Writes for one event then
+# only lock that event's file. Each thread keeps up to EVENT_SHARD_CONNECTIONS of them open.
+EVENT_SHARDS = (os.environ.get("EVENT_SHARDS", "") or "").strip().lower() in ("1", "true", "yes", "on")
+EVENT_SHARD_DIR = os.environ.get("EVENT_SHARD_DIR") or f"{DB_PATH}-events"
+EVENT_SHARD_CONNECTIONS = int(os.environ.get("EVENT_SHARD_CONNECTIONS", "8") or "8")
+# Optional single writer: mutations are queued to one thread per worker process, which
+# commits everything pending (up to WRITE_BATCH_MAX jobs) as one transaction. Writers of
+# different worker processes still contend for the SQLite lock (busy_timeout).
+WRITE_QUEUE = (os.environ.get("WRITE_QUEUE", "") or "").strip().lower() in ("1", "true", "yes", "on")
+WRITE_BATCH_MAX = int(os.environ.get("WRITE_BATCH_MAX", "256") or "256")
+# Idempotency keys for /mark and /add retries: the newest IDEMPOTENCY_CACHE_SIZE responses
+# are replayed from memory, and every key is also stored (in the write's own transaction)
+# for IDEMPOTENCY_TTL_HOURS so retries that reach another worker replay too.
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000") or "10000")
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get("IDEMPOTENCY_TTL_HOURS", "48") or "48")
+# Production profiler: one request in PROFILE_SAMPLE_EVERY to each route in PROFILE_ROUTES
+# (comma-separated url rules, e.g. "/mark,/export") is profiled into PROFILE_DIR.
+# PROFILE_MODE "stack" samples the request thread every PROFILE_INTERVAL_MS into folded
+# stacks for flamegraph.pl/speedscope; "cprofile" dumps a .prof per profiled request.
+# Admins can change these at runtime through /admin/api/profiler (shared by all workers).
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or f"{DB_PATH}-profiles"
+PROFILE_ROUTES = os.environ.get("PROFILE_ROUTES", "")
+PROFILE_SAMPLE_EVERY = int(os.environ.get("PROFILE_SAMPLE_EVERY", "1") or "1")
+PROFILE_MODE = (os.environ.get("PROFILE_MODE", "stack") or "stack").strip().lower()
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5") or "5")
+# Rows per executemany/commit when loading a roster (the write lock is released between chunks).
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "5000") or "5000")
+# Rows echoed back by the import preview (the full count is always reported).
+IMPORT_PREVIEW_ROWS = int(os.environ.get("IMPORT_PREVIEW_ROWS", "500") or "500")
+# Archived (closed, cold) events: one gzip JSON file per event, still served by /export.
+# Freed pages are returned to the filesystem ARCHIVE_VACUUM_PAGES at a time.
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR") or f"{DB_PATH}-archive"
+ARCHIVE_VACUUM_PAGES = int(os.environ.get("ARCHIVE_VACUUM_PAGES", "2000") or "2000")
 
 
 app = Flask(__name__, template_folder="templates")
@@ -22,22 +121,409 @@ def _now_str() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-def _parse_dt(s: str) -> datetime | None:
+# Metrics: counters and histograms live in memory per worker process and are written to
+# METRICS_DIR/worker-<pid>.json; /metrics sums every file, so totals cover all gunicorn
+# workers (including ones that have since exited).
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_METRIC_HELP = {
+    "attendance_http_requests_total": ("counter", "HTTP requests by route, method and status."),
+    "attendance_http_request_duration_seconds": ("histogram", "Time to response headers by route and method."),
+    "attendance_db_connections_opened_total": ("counter", "SQLite connections opened."),
+    "attendance_db_statements_total": ("counter", "SQL statements executed."),
+    "attendance_db_commit_duration_seconds": ("histogram", "Time spent in COMMIT."),
+    "attendance_db_lock_wait_seconds": ("histogram", "Time BEGIN IMMEDIATE waited for the write lock."),
+    "attendance_db_busy_total": ("counter", "Operations that failed with SQLITE_BUSY / database is locked."),
+    "attendance_db_write_jobs_total": ("counter", "Write jobs committed by the WRITE_QUEUE writer thread."),
+    "attendance_db_write_batches_total": ("counter", "Transactions (group commits) run by the WRITE_QUEUE writer thread."),
+}
+_metrics_lock = threading.Lock()
+_metrics: dict = {"pid": None, "counters": {}, "histograms": {}, "flushed": 0.0}
+
+
+def _metrics_store() -> dict:
+    # Caller holds _metrics_lock. A forked worker starts from zero rather than
+    # re-reporting what the parent recorded before the fork.
+    if _metrics["pid"] != os.getpid():
+        _metrics.update(pid=os.getpid(), counters={}, histograms={}, flushed=0.0)
+    return _metrics
+
+
+def _metric_inc(name: str, labels: tuple = (), value: float = 1) -> None:
+    with _metrics_lock:
+        counters = _metrics_store()["counters"]
+        counters[(name, labels)] = counters.get((name, labels), 0) + value
+
+
+def _metric_observe(name: str, seconds: float, labels: tuple = ()) -> None:
+    with _metrics_lock:
+        histograms = _metrics_store()["histograms"]
+        hist = histograms.get((name, labels))
+        if hist is None:
+            hist = histograms[(name, labels)] = [[0] * (len(_LATENCY_BUCKETS) + 1), 0.0, 0]
+        for i, bound in enumerate(_LATENCY_BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(_LATENCY_BUCKETS)
+        hist[0][i] += 1
+        hist[1] += seconds
+        hist[2] += 1
+
+
+def _metrics_flush(*, force: bool = False) -> None:
+    """Write this worker's snapshot (at most every METRICS_FLUSH_SECONDS unless forced)."""
+    with _metrics_lock:
+        store = _metrics_store()
+        now = time.monotonic()
+        if not force and now - store["flushed"] < METRICS_FLUSH_SECONDS:
+            return
+        store["flushed"] = now
+        snapshot = {
+            "counters": [[name, list(labels), value] for (name, labels), value in store["counters"].items()],
+            "histograms": [[name, list(labels), *hist] for (name, labels), hist in store["histograms"].items()],
+        }
     try:
-        return datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
-    except Exception:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        app.logger.exception("Could not write metrics snapshot")
+
+
+def _metrics_collect() -> tuple[dict, dict]:
+    """Sum every worker's snapshot: ({(name, labels): value}, {(name, labels): [buckets, sum, count]})."""
+    counters: dict = {}
+    histograms: dict = {}
+    try:
+        names = [n for n in os.listdir(METRICS_DIR) if n.startswith("worker-") and n.endswith(".json")]
+    except OSError:
+        names = []
+    for file_name in names:
+        try:
+            with open(os.path.join(METRICS_DIR, file_name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in snapshot.get("counters", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, total, count in snapshot.get("histograms", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            hist = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+            hist[1] += total
+            hist[2] += count
+    return counters, histograms
+
+
+_slow_sql_log = logging.getLogger("attendance.slow_sql")
+if SQL_SLOW_LOG:
+    _slow_sql_handler = logging.FileHandler(SQL_SLOW_LOG)
+    _slow_sql_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    _slow_sql_log.addHandler(_slow_sql_handler)
+    _slow_sql_log.setLevel(logging.INFO)
+
+
+def _sql_profile_start(args: tuple) -> dict | None:
+    """Open a profile entry for this statement when SQL_PROFILE is on and a request is active."""
+    if not SQL_PROFILE or not has_request_context():
         return None
+    sql, params = args[0], args[1] if len(args) > 1 else ()
+    if isinstance(params, dict):
+        shape = {key: type(value).__name__ for key, value in params.items()}
+    elif isinstance(params, (list, tuple)):
+        shape = [type(value).__name__ for value in params]
+    else:
+        shape = "<iterable>"  # executemany rows: not materialized just to describe them
+    entry = {"sql": " ".join(str(sql).split()), "params": shape, "ms": 0.0, "rows": 0}
+    g.setdefault("sql_profile", []).append(entry)
+    return entry
+
+
+class _ProfiledCursor(sqlite3.Cursor):
+    """Cursor that adds fetch time and fetched row counts to its statement's profile entry."""
+
+    _profile: dict | None = None
+
+    def _track(self, t0: float, rows: int) -> None:
+        if self._profile is not None:
+            self._profile["ms"] += (time.perf_counter() - t0) * 1000
+            self._profile["rows"] += rows
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = super().fetchone()
+        self._track(t0, row is not None)
+        return row
+
+    def fetchmany(self, *args):
+        t0 = time.perf_counter()
+        rows = super().fetchmany(*args)
+        self._track(t0, len(rows))
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = super().fetchall()
+        self._track(t0, len(rows))
+        return rows
+
+    def __next__(self):
+        t0 = time.perf_counter()
+        row = super().__next__()
+        self._track(t0, 1)
+        return row
+
+
+class _MeteredConnection(sqlite3.Connection):
+    """sqlite3 connection that counts statements and times commits (including `with conn:` blocks).
+
+    An executemany counts once: it is one prepared statement however many rows it binds.
+    With SQL_PROFILE on, statements run inside a request are also timed per request.
+    """
 
+    def execute(self, *args) -> sqlite3.Cursor:
+        _metric_inc("attendance_db_statements_total")
+        entry = _sql_profile_start(args)
+        if entry is None:
+            return super().execute(*args)
+        return self._profiled(entry, "execute", args)
+
+    def executemany(self, *args) -> sqlite3.Cursor:
+        _metric_inc("attendance_db_statements_total")
+        entry = _sql_profile_start(args)
+        if entry is None:
+            return super().executemany(*args)
+        cursor = self._profiled(entry, "executemany", args)
+        entry["rows"] = max(cursor.rowcount, 0)
+        return cursor
+
+    def _profiled(self, entry: dict, method: str, args: tuple) -> sqlite3.Cursor:
+        # Same as Connection.execute, but on a cursor that keeps feeding the profile entry.
+        cursor = self.cursor(_ProfiledCursor)
+        t0 = time.perf_counter()
+        try:
+            getattr(cursor, method)(*args)
+        finally:
+            entry["ms"] += (time.perf_counter() - t0) * 1000
+        cursor._profile = entry
+        return cursor
+
+    def commit(self) -> None:
+        if not self.in_transaction:
+            return
+        t0 = time.perf_counter()
+        super().commit()
+        _metric_observe("attendance_db_commit_duration_seconds", time.perf_counter() - t0)
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
 
-def _db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+
+_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+_conn_local = threading.local()
+_connection_serials = itertools.count(1)
+
+
+def _connect(path: str = DB_PATH) -> sqlite3.Connection:
+    # uri=True only changes "file:" names; plain paths open as before.
+    conn = sqlite3.connect(path, timeout=max(SQLITE_BUSY_TIMEOUT_MS, 0) / 1000.0, factory=_MeteredConnection, uri=True)
     conn.row_factory = sqlite3.Row
+    conn.serial = next(_connection_serials)
+    _metric_inc("attendance_db_connections_opened_total")
+    if SQLITE_JOURNAL_MODE in _JOURNAL_MODES:
+        conn.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    if SQLITE_SYNCHRONOUS in _SYNCHRONOUS_MODES:
+        conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {max(SQLITE_BUSY_TIMEOUT_MS, 0)}")
+    # Negative cache_size is in KiB rather than pages.
+    conn.execute(f"PRAGMA cache_size = {-max(SQLITE_CACHE_SIZE_KB, 0)}")
+    conn.execute(f"PRAGMA mmap_size = {max(SQLITE_MMAP_SIZE, 0)}")
+    return conn
+
+
+def _db() -> sqlite3.Connection:
+    """Return this thread's pooled connection, opening and tuning it on first use.
+
+    Use as `with _db() as conn:` - the context manager commits (or rolls back) but
+    leaves the connection open, so every helper in a request/worker thread reuses it.
+    With EVENT_SHARDS, inside `_event_scope(event_id)` (every request naming an event
+    runs in one) this is the connection with that event's shard attached.
+    """
+    event_id = getattr(_conn_local, "event_id", None)
+    if EVENT_SHARDS and event_id:
+        return _event_db(event_id)
+    return _catalog_db()
+
+
+def _catalog_db() -> sqlite3.Connection:
+    conn = getattr(_conn_local, "conn", None)
+    # Never reuse a connection inherited across fork (gunicorn workers).
+    if conn is None or getattr(_conn_local, "pid", None) != os.getpid():
+        conn = _connect()
+        _conn_local.conn = conn
+        _conn_local.pid = os.getpid()
+        _conn_local.event_conns = OrderedDict()
+    return conn
+
+
+def _close_db() -> None:
+    conn = getattr(_conn_local, "conn", None)
+    _conn_local.conn = None
+    if getattr(_conn_local, "pid", None) != os.getpid():
+        return
+    for event_conn in getattr(_conn_local, "event_conns", {}).values():
+        try:
+            event_conn.close()
+        except Exception:
+            pass
+    _conn_local.event_conns = OrderedDict()
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _event_scopes() -> list[int | None]:
+    """Scopes to visit for a query over all events: every event with EVENT_SHARDS, else just the one file."""
+    if not EVENT_SHARDS:
+        return [None]
+    with _event_scope(None), _db() as conn:
+        return [int(r[0]) for r in conn.execute("SELECT event_id FROM events ORDER BY event_id")]
+
+
+@contextmanager
+def _event_scope(event_id: int | None):
+    """Route `_db()` on this thread to the event's shard (EVENT_SHARDS); None means the catalog."""
+    previous = getattr(_conn_local, "event_id", None)
+    _conn_local.event_id = event_id
+    try:
+        yield
+    finally:
+        _conn_local.event_id = previous
+
+
+_EVENT_TABLES = ("students", "students_fts", "session_attendance", "session_counters", "event_versions", "idempotency_keys")
+_CATALOG_TABLES = ("events", "sessions", "devices", "pending_imports", "pending_import_rows")
+_ready_shards: set[str] = set()
+_ready_shards_lock = threading.Lock()
+
+
+def _shard_path(event_id: int) -> str:
+    return os.path.join(EVENT_SHARD_DIR, f"event-{int(event_id)}.db")
+
+
+def _ensure_shard(path: str) -> None:
+    """Create (or migrate) an event shard: the full schema with the catalog tables dropped."""
+    with _ready_shards_lock:
+        if path in _ready_shards:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = _connect(path)
+        try:
+            if _schema_version(conn) < len(MIGRATIONS):
+                _create_schema(conn)
+                _drop_tables(conn, _CATALOG_TABLES)
+            else:
+                # The catalog has no students_fts, so this is what sets _FTS_ENABLED.
+                _init_students_fts(conn.cursor())
+                conn.commit()
+        finally:
+            conn.close()
+        _ready_shards.add(path)
+
+
+def _event_db(event_id: int) -> sqlite3.Connection:
+    catalog = _catalog_db()  # also resets this thread's pool after a fork
+    conns: OrderedDict = _conn_local.event_conns
+    conn = conns.get(event_id)
+    if conn is not None and conn.shard_readonly and os.path.exists(_shard_path(event_id)):
+        conn.close()
+        conn = None
+    if conn is None:
+        path = _shard_path(event_id)
+        readonly = False
+        if not os.path.exists(path):
+            exists = catalog.execute("SELECT 1 FROM events WHERE event_id = ?", (event_id,)).fetchone()
+            if not exists:
+                # Unknown event: an empty read-only shard, so lookups find nothing (404s as usual).
+                path, readonly = os.path.join(EVENT_SHARD_DIR, "empty.db"), True
+        _ensure_shard(path)
+        conn = _connect()
+        target = f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro" if readonly else path
+        conn.execute("ATTACH DATABASE ? AS event", (target,))
+        if SQLITE_SYNCHRONOUS in _SYNCHRONOUS_MODES:
+            conn.execute(f"PRAGMA event.synchronous = {SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA event.cache_size = {-max(SQLITE_CACHE_SIZE_KB, 0)}")
+        conn.shard = "event"
+        conn.shard_readonly = readonly
+        conns[event_id] = conn
+        while len(conns) > max(EVENT_SHARD_CONNECTIONS, 1):
+            _, evicted = conns.popitem(last=False)
+            try:
+                evicted.close()
+            except Exception:
+                pass
+    conns.move_to_end(event_id)
     return conn
 
 
+def _data_version(conn: sqlite3.Connection) -> tuple[int, int]:
+    """(connection serial, PRAGMA data_version) of the file holding the connection's event data.
+
+    data_version values are only comparable on one connection, hence the serial.
+    """
+    version = conn.execute(f"PRAGMA {getattr(conn, 'shard', None) or 'main'}.data_version").fetchone()[0]
+    return conn.serial, int(version)
+
+
+def _drop_tables(conn: sqlite3.Connection, tables: Iterable[str]) -> None:
+    _begin_write(conn)
+    for table in tables:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.commit()
+
+
 def init_db() -> None:
     with _db() as conn:
+        # A sharded catalog has already dropped the per-event tables; don't recreate them.
+        if not EVENT_SHARDS or _schema_version(conn) < len(MIGRATIONS):
+            _create_schema(conn)
+        if EVENT_SHARDS:
+            _split_event_tables(conn)
+
+        # Ensure at least one event exists (helps older Android local migrations that map to eventId=1).
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) AS n FROM events")
+        if int(c.fetchone()[0]) == 0:
+            c.execute(
+                "INSERT INTO events (event_name, start_time, end_time, is_active, created_at) VALUES (?, ?, ?, ?, ?)",
+                ("Default Event", "", "", 1, _now_str()),
+            )
+            # Default session for the seeded event.
+            c.execute("SELECT event_id FROM events ORDER BY event_id ASC LIMIT 1")
+            seeded_id = c.fetchone()[0]
+            c.execute(
+                "INSERT INTO sessions (event_id, session_name, is_active, created_at) VALUES (?, ?, ?, ?)",
+                (int(seeded_id), "Session 1", 1, _now_str()),
+            )
+        conn.commit()
+
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    """Create every table (latest shape) and apply pending MIGRATIONS."""
+    with conn:
         c = conn.cursor()
+        # Only takes effect on a new, empty file; existing ones switch on their first compaction.
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
         c.execute(
             """
             CREATE TABLE IF NOT EXISTS events (
@@ -46,7 +532,8 @@ def init_db() -> None:
                 start_time TEXT,
                 end_time   TEXT,
                 is_active  INTEGER NOT NULL DEFAULT 0,
-                created_at TEXT NOT NULL
+                created_at TEXT NOT NULL,
+                archived_at TEXT NOT NULL DEFAULT ''
             )
             """
         )
@@ -63,6 +550,7 @@ def init_db() -> None:
                 source          TEXT NOT NULL DEFAULT 'Imported',
                 device_id       TEXT NOT NULL DEFAULT '',
                 device_timestamp TEXT NOT NULL DEFAULT '',
+                roster_version  INTEGER NOT NULL DEFAULT 0,
                 PRIMARY KEY (event_id, uid),
                 FOREIGN KEY (event_id) REFERENCES events(event_id)
             )
@@ -103,51 +591,786 @@ def init_db() -> None:
                 source           TEXT NOT NULL,
                 device_id        TEXT NOT NULL DEFAULT '',
                 device_timestamp TEXT NOT NULL DEFAULT '',
+                seq              INTEGER NOT NULL DEFAULT 0,
                 PRIMARY KEY (session_id, uid),
                 FOREIGN KEY (session_id) REFERENCES sessions(session_id),
                 FOREIGN KEY (event_id) REFERENCES events(event_id)
             )
             """
         )
-        # Ensure at least one event exists (helps older Android local migrations that map to eventId=1).
-        c.execute("SELECT COUNT(*) AS n FROM events")
-        if int(c.fetchone()[0]) == 0:
-            c.execute(
-                "INSERT INTO events (event_name, start_time, end_time, is_active, created_at) VALUES (?, ?, ?, ?, ?)",
-                ("Default Event", "", "", 1, _now_str()),
+
+        # Normalized rows of an uploaded roster between preview and confirm (keyed by token).
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_imports (
+                token      TEXT PRIMARY KEY,
+                row_count  INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL
             )
-            # Default session for the seeded event.
-            c.execute("SELECT event_id FROM events ORDER BY event_id ASC LIMIT 1")
-            seeded_id = c.fetchone()[0]
-            c.execute(
-                "INSERT INTO sessions (event_id, session_name, is_active, created_at) VALUES (?, ?, ?, ?)",
-                (int(seeded_id), "Session 1", 1, _now_str()),
+            """
+        )
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_import_rows (
+                token  TEXT NOT NULL,
+                seq    INTEGER NOT NULL,
+                uid    TEXT NOT NULL,
+                name   TEXT NOT NULL,
+                branch TEXT NOT NULL DEFAULT '',
+                year   TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (token, seq)
+            )
+            """
+        )
+        # Per-event change counters; bumping them in a write invalidates every worker's roster index.
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS event_versions (
+                event_id        INTEGER PRIMARY KEY,
+                roster_version  INTEGER NOT NULL DEFAULT 0,
+                session_version INTEGER NOT NULL DEFAULT 0
             )
+            """
+        )
+
+        _init_students_fts(c)
         conn.commit()
 
+        # Columns, indexes and tables added after the first release.
+        _migrate(conn)
 
-init_db()
 
+def _split_event_tables(conn: sqlite3.Connection) -> None:
+    """Move per-event rows from a single-file database into event shards, then drop them.
 
-def _touch_device(device_id: str, event_id: int | None = None) -> None:
-    device_id = (device_id or "").strip()
-    if not device_id:
+    Runs once, when EVENT_SHARDS is first enabled on an existing database. Stored
+    idempotency keys are not carried over (clients retrying across the switch get a
+    fresh result rather than a replay).
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'students'").fetchone():
         return
-    ip = (request.headers.get("X-Forwarded-For") or request.remote_addr or "").split(",")[0].strip()
-    now = _now_str()
-    with _db() as conn:
+    # Also reached when an already split catalog was behind: _create_schema recreated the
+    # base tables empty, but not the ones only migrations create.
+    tables = [t for t in ("students", "session_attendance", "session_counters", "event_versions") if _has_table(conn, t)]
+    event_ids = [int(r[0]) for r in conn.execute(" UNION ".join(f"SELECT event_id FROM {t}" for t in tables))]
+    for event_id in event_ids:
+        path = _shard_path(event_id)
+        _ensure_shard(path)
+        conn.execute("ATTACH DATABASE ? AS split", (path,))
+        try:
+            _begin_write(conn)
+            for table in tables:
+                columns = ", ".join(r[1] for r in conn.execute(f"PRAGMA table_info({table})"))
+                conn.execute(
+                    f"INSERT OR REPLACE INTO split.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE event_id = ?",
+                    (event_id,),
+                )
+            if _FTS_ENABLED:
+                conn.execute("INSERT INTO split.students_fts (students_fts) VALUES ('delete-all')")
+                conn.execute(
+                    """
+                    INSERT INTO split.students_fts (rowid, ev, uid, name)
+                    SELECT rowid, '#' || event_id || '#', uid, name FROM split.students
+                    """
+                )
+            conn.commit()
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.execute("DETACH DATABASE split")
+        app.logger.info("Moved event %s into %s", event_id, path)
+    _drop_tables(conn, _EVENT_TABLES)
+
+
+def _has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    return column in {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _has_table(conn: sqlite3.Connection, table: str) -> bool:
+    # An EVENT_SHARDS catalog has dropped the per-event tables that migrations created.
+    return conn.execute(f"PRAGMA table_info({table})").fetchone() is not None
+
+
+def _migration_session_attendance_seq(conn: sqlite3.Connection) -> None:
+    # seq: per-session scan sequence, the cursor for incremental dashboard/live feeds.
+    if not _has_column(conn, "session_attendance", "seq"):
+        conn.execute("ALTER TABLE session_attendance ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        conn.execute("UPDATE session_attendance SET seq = rowid")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_session_attendance_seq ON session_attendance (event_id, session_id, seq)"
+    )
+
+
+def _migration_students_roster_version(conn: sqlite3.Connection) -> None:
+    # roster_version: the event roster version that last wrote the row (roster delta sync).
+    if not _has_column(conn, "students", "roster_version"):
+        conn.execute("ALTER TABLE students ADD COLUMN roster_version INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_students_roster_version ON students (event_id, roster_version)")
+
+
+def _migration_session_counters(conn: sqlite3.Connection) -> None:
+    # Materialized summary counters, maintained by every writer in its own transaction.
+    # session_id 0 holds event-wide counters ("total"); real sessions hold "present",
+    # "source:<source>" and "device:<device_id>".
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS session_counters (
+            event_id   INTEGER NOT NULL,
+            session_id INTEGER NOT NULL,
+            name       TEXT NOT NULL,
+            value      INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (event_id, session_id, name)
+        ) WITHOUT ROWID
+        """
+    )
+    _rebuild_session_counters(conn)
+
+
+def _migration_hot_query_indexes(conn: sqlite3.Connection) -> None:
+    # Active/newest session lookups: WHERE event_id = ? [AND is_active = 1] ORDER BY session_id DESC.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_event ON sessions (event_id, session_id)")
+    # Dashboard device list: WHERE last_event_id = ?.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_devices_last_event ON devices (last_event_id)")
+    # Present-only export: WHERE event_id = ? AND session_id = ? ORDER BY timestamp DESC.
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_session_attendance_time ON session_attendance (event_id, session_id, timestamp)"
+    )
+    # Roster endpoint and full export: WHERE event_id = ? ORDER BY name, uid.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_students_event_name ON students (event_id, name, uid)")
+    # Stale preview cleanup: WHERE created_at < ?.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_imports_created ON pending_imports (created_at)")
+
+
+def _migration_idempotency_keys(conn: sqlite3.Connection) -> None:
+    # Stored /mark and /add responses keyed by client idempotency key (see _idempotent_write).
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key        TEXT PRIMARY KEY,
+            status     INTEGER NOT NULL,
+            body       TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)")
+
+
+def _migration_events_archived_at(conn: sqlite3.Connection) -> None:
+    # archived_at: set when the event's rows were moved to ARCHIVE_DIR (see _archive_event).
+    if not _has_column(conn, "events", "archived_at"):
+        conn.execute("ALTER TABLE events ADD COLUMN archived_at TEXT NOT NULL DEFAULT ''")
+
+
+def _migration_arrival_rate_counters(conn: sqlite3.Connection) -> None:
+    # Per-minute "minute:" / "device_minute:" buckets in session_counters (see _arrival_rates).
+    if _has_table(conn, "session_counters"):
+        _rebuild_session_counters(conn)
+
+
+def _migration_students_name_search_index(conn: sqlite3.Connection) -> None:
+    # /search name-prefix hits: WHERE event_id = ? AND name >= ? COLLATE NOCASE ... ORDER BY name COLLATE NOCASE.
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_students_event_name_nocase ON students (event_id, name COLLATE NOCASE, uid)"
+    )
+
+
+def _migration_open_state_indexes(conn: sqlite3.Connection) -> None:
+    # Open events/sessions only (metrics gauges, /events?active=1, global /stats).
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_open ON events (event_id) WHERE is_active = 1")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_open ON sessions (event_id, session_id) WHERE is_active = 1")
+    # Global /stats roster total: SUM of every event's 'total' counter.
+    if _has_table(conn, "session_counters"):
         conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_session_counters_event_wide ON session_counters (name, event_id, value)"
+            " WHERE session_id = 0"
+        )
+    # Online devices gauge: WHERE last_seen >= ? GROUP BY last_event_id.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_devices_last_seen ON devices (last_seen, last_event_id)")
+
+
+def _migration_idempotency_request_hash(conn: sqlite3.Connection) -> None:
+    # request_hash: which (event_id, uid) a stored response belongs to ('' on older rows).
+    if _has_table(conn, "idempotency_keys") and not _has_column(conn, "idempotency_keys", "request_hash"):
+        conn.execute("ALTER TABLE idempotency_keys ADD COLUMN request_hash TEXT NOT NULL DEFAULT ''")
+
+
+def _migration_arrival_rate_device_minutes(conn: sqlite3.Connection) -> None:
+    # Minute buckets now follow the device's scan time (see _scan_minute); re-bucket old rows.
+    if _has_table(conn, "session_counters"):
+        _rebuild_session_counters(conn)
+
+
+# Schema migrations, applied in order; PRAGMA user_version records how many have run.
+# Append only - never reorder or edit a released entry. Each one must also be safe on a
+# fresh database, where init_db's CREATE TABLE statements already have the latest shape.
+MIGRATIONS = (
+    ("session_attendance.seq feed cursor", _migration_session_attendance_seq),
+    ("students.roster_version for roster delta sync", _migration_students_roster_version),
+    ("session_counters summary table", _migration_session_counters),
+    ("indexes for hot queries", _migration_hot_query_indexes),
+    ("idempotency_keys replay store", _migration_idempotency_keys),
+    ("events.archived_at for cold-event archives", _migration_events_archived_at),
+    ("per-minute arrival-rate counters", _migration_arrival_rate_counters),
+    ("case-insensitive name index for search", _migration_students_name_search_index),
+    ("partial indexes for open events/sessions, counter totals and online devices", _migration_open_state_indexes),
+    ("idempotency_keys.request_hash to reject reused keys", _migration_idempotency_request_hash),
+    ("arrival-rate minutes by device scan time", _migration_arrival_rate_device_minutes),
+)
+
+
+def _schema_version(conn: sqlite3.Connection) -> int:
+    return int(conn.execute("PRAGMA user_version").fetchone()[0])
+
+
+def _migrate(conn: sqlite3.Connection) -> int:
+    """Apply pending MIGRATIONS, each in its own write transaction.
+
+    Safe to run from several workers at once: the version is re-read under the write
+    lock, so each migration runs exactly once.
+
+    Returns: the schema version after migrating.
+    """
+    for version, (description, migration) in enumerate(MIGRATIONS, start=1):
+        _begin_write(conn)
+        if _schema_version(conn) >= version:
+            conn.commit()
+            continue
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+        app.logger.info("Applied schema migration %d: %s", version, description)
+    return _schema_version(conn)
+
+
+def _query_plan_scans(conn: sqlite3.Connection) -> list[tuple[str, str]]:
+    """(query name, plan step) for every HOT_QUERIES step that scans a table without an index."""
+    scans = []
+    for name, sql in HOT_QUERIES:
+        if "students_fts" in sql and not _FTS_ENABLED:
+            continue
+        params = [None] * sql.count("?")
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = str(row[3])
+            if detail == FULL_SCAN_QUERIES.get(name):
+                continue
+            if detail.startswith("SCAN ") and "INDEX" not in detail and "CONSTANT ROW" not in detail:
+                scans.append((name, detail))
+    return scans
+
+
+@app.cli.command("migrate")
+def migrate_command() -> None:
+    """Apply pending schema migrations (also done on startup) and print the version."""
+    with _db() as conn:
+        version = _migrate(conn)
+    click.echo(f"Schema at version {version} of {len(MIGRATIONS)}.")
+
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command() -> None:
+    """Fail if any hot query's EXPLAIN QUERY PLAN contains an unindexed table scan."""
+    # With EVENT_SHARDS, plan against an event shard so every table resolves.
+    with _event_scope(next(iter(_event_scopes()), None)), _db() as conn:
+        scans = _query_plan_scans(conn)
+    for name, detail in scans:
+        click.echo(f"{name}: {detail}")
+    if scans:
+        raise SystemExit(f"{len(scans)} hot query step(s) scan a table without an index.")
+    click.echo(f"All {len(HOT_QUERIES)} hot queries use indexes.")
+
+
+def _init_students_fts(c: sqlite3.Cursor) -> None:
+    """Contentless trigram FTS5 index over students.uid/name.
+
+    Besides uid/name it indexes an "#<event_id>#" token, so the per-event filter is
+    resolved inside the index and a LIMIT stops the match early. Writers that change
+    uid/name (imports, /add) maintain it via _fts_unindex/_fts_index in the same
+    transaction; /mark only updates status and never touches it. Leaves _FTS_ENABLED
+    False when this SQLite build has no FTS5/trigram support.
+    """
+    global _FTS_ENABLED
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'students_fts'").fetchone()
+    try:
+        c.execute(
             """
-            INSERT INTO devices (device_id, last_seen, last_event_id, last_ip)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(device_id) DO UPDATE SET
-                last_seen = excluded.last_seen,
-                last_event_id = COALESCE(excluded.last_event_id, devices.last_event_id),
-                last_ip = excluded.last_ip
-            """,
-            (device_id, now, event_id, ip),
+            CREATE VIRTUAL TABLE IF NOT EXISTS students_fts
+            USING fts5(ev, uid, name, content='', tokenize='trigram')
+            """
+        )
+    except sqlite3.OperationalError:
+        _FTS_ENABLED = False
+        return
+
+    if not exists:
+        # Backfill rosters imported before the index existed.
+        c.execute(
+            """
+            INSERT INTO students_fts (rowid, ev, uid, name)
+            SELECT rowid, '#' || event_id || '#', uid, name FROM students
+            """
+        )
+    _FTS_ENABLED = True
+
+
+def _uid_list(uids: Iterable[str]) -> str:
+    """The distinct `uids` as a JSON array, for the json_each(?) statements below.
+
+    Distinct matters: deleting the same row twice corrupts a contentless FTS index.
+    """
+    return json.dumps(list(dict.fromkeys(uids)))
+
+
+# Driven by the UID list (CROSS JOIN keeps json_each outermost), so each UID is one
+# primary-key lookup instead of a walk over the event's whole roster.
+_FTS_UNINDEX_SQL = """
+    INSERT INTO students_fts (students_fts, rowid, ev, uid, name)
+    SELECT 'delete', s.rowid, '#' || s.event_id || '#', s.uid, s.name
+      FROM json_each(?) j
+     CROSS JOIN students s ON s.event_id = ? AND s.uid = j.value
+"""
+_FTS_INDEX_SQL = """
+    INSERT INTO students_fts (rowid, ev, uid, name)
+    SELECT s.rowid, '#' || s.event_id || '#', s.uid, s.name
+      FROM json_each(?) j
+     CROSS JOIN students s ON s.event_id = ? AND s.uid = j.value
+"""
+_NEW_UIDS_COUNT_SQL = """
+    SELECT COUNT(*) FROM json_each(?) j
+     WHERE NOT EXISTS (SELECT 1 FROM students s WHERE s.event_id = ? AND s.uid = j.value)
+"""
+
+
+def _fts_unindex(conn: sqlite3.Connection, event_id: int, uids: Iterable[str]) -> None:
+    """Drop the current index entries of these students; call before rewriting their rows.
+
+    Done set-based in application code rather than with triggers or per-row statements:
+    FTS5 flushes its pending buffer at every statement savepoint, which makes per-row
+    indexing several times slower for bulk imports.
+    """
+    if _FTS_ENABLED:
+        conn.execute(_FTS_UNINDEX_SQL, (_uid_list(uids), event_id))
+
+
+def _fts_index(conn: sqlite3.Connection, event_id: int, uids: Iterable[str]) -> None:
+    """Index the current rows of these students; pair with a preceding _fts_unindex."""
+    if _FTS_ENABLED:
+        conn.execute(_FTS_INDEX_SQL, (_uid_list(uids), event_id))
+
+
+def _count_new_uids(conn: sqlite3.Connection, event_id: int, uids: Iterable[str]) -> int:
+    """How many distinct `uids` are not yet on the event's roster."""
+    return int(conn.execute(_NEW_UIDS_COUNT_SQL, (_uid_list(uids), event_id)).fetchone()[0])
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+_FTS_ENABLED = False
+
+
+@app.before_request
+def _start_request_timer() -> None:
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response: Response) -> Response:
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        _metric_inc("attendance_http_requests_total", (("route", route), ("method", request.method), ("status", str(response.status_code))))
+        _metric_observe(
+            "attendance_http_request_duration_seconds",
+            time.perf_counter() - started,
+            (("route", route), ("method", request.method)),
         )
+        _metrics_flush()
+    return response
+
+
+@app.after_request
+def _sql_profile_headers(response: Response) -> Response:
+    entries = g.get("sql_profile")
+    if not SQL_PROFILE or entries is None:
+        return response
+    total_ms = sum(e["ms"] for e in entries)
+    response.headers["X-DB-Queries"] = str(len(entries))
+    response.headers["X-DB-Time-ms"] = f"{total_ms:.2f}"
+    for e in entries:
+        if e["ms"] >= SQL_SLOW_MS:
+            _slow_sql_log.warning(
+                "slow sql %.1fms rows=%d %s %s: %s params=%s",
+                e["ms"], e["rows"], request.method, request.path, e["sql"], e["params"],
+            )
+    return response
+
+
+PROFILE_MODES = ("stack", "cprofile")
+_profiler_lock = threading.Lock()
+_profiler: dict = {"settings": None, "mtime": None, "checked": 0.0, "seen": Counter()}
+_profiled_threads: dict[int, Counter] = {}
+_profiler_wakeup = threading.Event()
+_profiler_thread_pid: list[int] = []
+
+
+def _profiler_settings_path() -> str:
+    return os.path.join(PROFILE_DIR, "settings.json")
+
+
+def _normalize_profiler_settings(raw: dict) -> dict:
+    routes = raw.get("routes") or []
+    if isinstance(routes, str):
+        routes = routes.split(",")
+    mode = str(raw.get("mode") or "stack").strip().lower()
+    try:
+        every = max(int(raw.get("every") or 1), 1)
+    except (TypeError, ValueError):
+        every = 1
+    return {
+        "routes": sorted({str(r).strip() for r in routes if str(r).strip()}),
+        "every": every,
+        "mode": mode if mode in PROFILE_MODES else "stack",
+    }
+
+
+def _profiler_settings() -> dict:
+    """Current profiler settings: PROFILE_DIR/settings.json if an admin saved one, else the env."""
+    now = time.monotonic()
+    with _profiler_lock:
+        if _profiler["settings"] is not None and now - _profiler["checked"] < 1.0:
+            return _profiler["settings"]
+        _profiler["checked"] = now
+        try:
+            mtime = os.stat(_profiler_settings_path()).st_mtime_ns
+        except OSError:
+            mtime = None
+        if _profiler["settings"] is None or mtime != _profiler["mtime"]:
+            raw = {"routes": PROFILE_ROUTES, "every": PROFILE_SAMPLE_EVERY, "mode": PROFILE_MODE}
+            if mtime is not None:
+                try:
+                    with open(_profiler_settings_path()) as f:
+                        raw = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            _profiler.update(settings=_normalize_profiler_settings(raw), mtime=mtime, seen=Counter())
+        return _profiler["settings"]
+
+
+def _save_profiler_settings(raw: dict) -> dict:
+    settings = _normalize_profiler_settings(raw)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = _profiler_settings_path()
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(settings, f)
+    os.replace(f"{path}.tmp", path)
+    with _profiler_lock:
+        _profiler["checked"] = 0.0
+    return settings
+
+
+def _profile_file(route: str, suffix: str) -> str:
+    slug = "".join(ch if ch.isalnum() else "_" for ch in route).strip("_") or "root"
+    return os.path.join(PROFILE_DIR, f"{slug}.{os.getpid()}{suffix}")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _profile_sampler() -> None:
+    while True:
+        if not _profiled_threads:
+            _profiler_wakeup.wait(1.0)
+            _profiler_wakeup.clear()
+            continue
+        frames = sys._current_frames()
+        with _profiler_lock:
+            for ident, stacks in _profiled_threads.items():
+                frame = frames.get(ident)
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                if labels:
+                    stacks[";".join(reversed(labels))] += 1
+        del frames
+        time.sleep(PROFILE_INTERVAL_MS / 1000)
+
+
+@app.before_request
+def _start_profiler() -> None:
+    if request.url_rule is None:
+        return
+    route = request.url_rule.rule
+    settings = _profiler_settings()
+    if route not in settings["routes"]:
+        return
+    with _profiler_lock:
+        _profiler["seen"][route] += 1
+        if (_profiler["seen"][route] - 1) % settings["every"]:
+            return
+        if settings["mode"] == "stack":
+            _profiled_threads[threading.get_ident()] = Counter()
+            if _profiler_thread_pid != [os.getpid()]:
+                _profiler_thread_pid[:] = [os.getpid()]
+                threading.Thread(target=_profile_sampler, name="profiler", daemon=True).start()
+    if settings["mode"] == "cprofile":
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return  # another request on this interpreter is already being profiled
+        g.cprofile = profile
+    else:
+        _profiler_wakeup.set()
+    g.profile_route = route
+
+
+@app.teardown_request
+def _stop_profiler(exc: BaseException | None) -> None:
+    # Teardown runs after streamed bodies (stream_with_context) finish, so exports are covered.
+    route = g.pop("profile_route", None)
+    if route is None:
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile = g.pop("cprofile", None)
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(_profile_file(route, f".{time.time_ns()}.prof"))
+            return
+        with _profiler_lock:
+            stacks = _profiled_threads.pop(threading.get_ident(), Counter())
+        if stacks:
+            # Folded format ("frame;frame;frame count"); flamegraph.pl sums repeated stacks.
+            with open(_profile_file(route, ".folded"), "a") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+    except OSError:
+        app.logger.exception("Could not write profile for %s", route)
+
+
+@app.teardown_request
+def _release_db(exc: BaseException | None) -> None:
+    if isinstance(exc, sqlite3.OperationalError) and ("locked" in str(exc) or "busy" in str(exc)):
+        _metric_inc("attendance_db_busy_total")
+    # Keep the pooled connection, but never let an unfinished transaction hold the write lock.
+    _conn_local.event_id = None
+    for conn in (getattr(_conn_local, "conn", None), *getattr(_conn_local, "event_conns", {}).values()):
+        if conn is not None and conn.in_transaction:
+            try:
+                conn.rollback()
+            except Exception:
+                _close_db()
+                break
+
+
+@app.before_request
+def _bind_event_shard() -> None:
+    """With EVENT_SHARDS, run the request in the scope of the event it names (if any)."""
+    if not EVENT_SHARDS:
+        return
+    view_args = request.view_args or {}
+    raw = view_args.get("event_id") or request.args.get("event_id") or request.form.get("event_id")
+    if raw is None and "session_id" in view_args:
+        with _db() as conn:
+            row = conn.execute("SELECT event_id FROM sessions WHERE session_id = ?", (view_args["session_id"],)).fetchone()
+        raw = row[0] if row else None
+    if raw is None and request.is_json:
+        data = request.get_json(silent=True)
+        raw = data.get("event_id") if isinstance(data, dict) else None
+    try:
+        event_id = int(raw) if raw is not None else 0
+    except (TypeError, ValueError):
+        event_id = 0
+    _conn_local.event_id = event_id if event_id > 0 else None
+
+
+# Device heartbeats are buffered per worker (latest per device) and written in one
+# batch: by the flusher thread every DEVICE_FLUSH_SECONDS, or inside the next scan
+# transaction that passes `conn`. Heartbeats alone never take the write lock per request.
+DEVICE_FLUSH_SECONDS = float(os.environ.get("DEVICE_FLUSH_SECONDS", "1") or "1")
+_device_heartbeats: dict[str, tuple[str, int | None, str]] = {}
+_device_heartbeats_lock = threading.Lock()
+_device_flusher_pid: list[int] = []
+
+
+def _touch_device(device_id: str, event_id: int | None = None, *, conn: sqlite3.Connection | None = None) -> None:
+    """Record a device heartbeat; with `conn`, flush pending heartbeats inside the caller's transaction (caller commits)."""
+    device_id = (device_id or "").strip()
+    if device_id:
+        ip = (request.headers.get("X-Forwarded-For") or request.remote_addr or "").split(",")[0].strip()
+        with _device_heartbeats_lock:
+            pending = _device_heartbeats.get(device_id)
+            if event_id is None and pending is not None:
+                event_id = pending[1]
+            _device_heartbeats[device_id] = (_now_str(), event_id, ip)
+            if _device_flusher_pid != [os.getpid()]:
+                _device_flusher_pid[:] = [os.getpid()]
+                threading.Thread(target=_device_flusher, name="device-heartbeats", daemon=True).start()
+    if conn is not None:
+        _flush_device_heartbeats(conn)
+
+
+_DEVICE_HEARTBEAT_SQL = """
+    INSERT INTO devices (device_id, last_seen, last_event_id, last_ip)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(device_id) DO UPDATE SET
+        last_seen = excluded.last_seen,
+        last_event_id = COALESCE(excluded.last_event_id, devices.last_event_id),
+        last_ip = excluded.last_ip
+"""
+
+
+def _flush_device_heartbeats(conn: sqlite3.Connection | None = None) -> None:
+    """Write buffered heartbeats; with `conn`, inside the caller's transaction (caller commits)."""
+    with _device_heartbeats_lock:
+        if not _device_heartbeats:
+            return
+        batch = dict(_device_heartbeats)
+        _device_heartbeats.clear()
+    sql = _DEVICE_HEARTBEAT_SQL
+    params = [(device_id, *beat) for device_id, beat in batch.items()]
+    if conn is not None and getattr(conn, "shard", None):
+        # Don't take the catalog write lock inside a shard transaction; the flusher writes them.
+        with _device_heartbeats_lock:
+            for device_id, beat in batch.items():
+                _device_heartbeats.setdefault(device_id, beat)
+        return
+    if conn is not None:
+        conn.executemany(sql, params)
+        return
+    try:
+        _run_write(lambda conn: conn.executemany(sql, params), catalog=True)
+    except sqlite3.Error:
+        # Put them back unless a newer beat for the device arrived meanwhile; retried next tick.
+        with _device_heartbeats_lock:
+            for device_id, beat in batch.items():
+                _device_heartbeats.setdefault(device_id, beat)
+        raise
+
+
+def _device_flusher() -> None:
+    while True:
+        time.sleep(max(DEVICE_FLUSH_SECONDS, 0.05))
+        try:
+            _flush_device_heartbeats()
+        except Exception:
+            app.logger.exception("Device heartbeat flush failed")
+
+
+@atexit.register
+def _flush_device_heartbeats_at_exit() -> None:
+    try:
+        _flush_device_heartbeats()
+    except Exception:
+        pass
+
+
+def _begin_write(conn: sqlite3.Connection, *, catalog: bool = False) -> None:
+    # Take the write lock up front: a deferred read-then-write transaction can fail with
+    # SQLITE_BUSY when it tries to upgrade, while BEGIN IMMEDIATE just waits on busy_timeout.
+    # BEGIN IMMEDIATE locks every attached file, so on an event shard connection only the
+    # shard is locked (by a no-op write) unless the transaction also writes the catalog.
+    if not conn.in_transaction:
+        t0 = time.perf_counter()
+        try:
+            if getattr(conn, "shard", None) and not catalog:
+                conn.execute("BEGIN")
+                if not conn.shard_readonly:
+                    conn.execute(f"UPDATE {conn.shard}.event_versions SET event_id = event_id WHERE 0")
+            else:
+                conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            _metric_inc("attendance_db_busy_total")
+            raise
+        _metric_observe("attendance_db_lock_wait_seconds", time.perf_counter() - t0)
+
+
+_write_jobs: queue.SimpleQueue = queue.SimpleQueue()
+_write_lock = threading.Lock()
+_writer_pid: list[int] = []
+
+
+def _run_write(fn: Callable[[sqlite3.Connection], object], *, catalog: bool = False):
+    """Run `fn(conn)` inside a write transaction, commit, and return its result.
+
+    With WRITE_QUEUE the job runs on the writer thread, grouped with whatever else is
+    pending, and this call returns once that group has committed (or re-raises what `fn`
+    or the commit raised). `fn` must not commit, and must not touch the request context.
+    It runs in the caller's `_event_scope`; pass `catalog=True` if it writes catalog
+    tables (events, sessions, devices) from inside an event scope.
+    """
+    if not WRITE_QUEUE:
+        with _db() as conn:
+            _begin_write(conn, catalog=catalog)
+            result = fn(conn)
+            conn.commit()
+        return result
+    with _write_lock:
+        if _writer_pid != [os.getpid()]:
+            _writer_pid[:] = [os.getpid()]
+            threading.Thread(target=_db_writer, name="db-writer", daemon=True).start()
+    future: Future = Future()
+    scope = getattr(_conn_local, "event_id", None) if EVENT_SHARDS else None
+    _write_jobs.put((fn, future, (scope, catalog)))
+    return future.result()
+
+
+def _db_writer() -> None:
+    while True:
+        batch = [_write_jobs.get()]
+        while len(batch) < max(WRITE_BATCH_MAX, 1):
+            try:
+                batch.append(_write_jobs.get_nowait())
+            except queue.Empty:
+                break
+        # One transaction per shard (and lock mode); jobs keep their order within a group.
+        groups: dict[tuple, list] = {}
+        for fn, future, key in batch:
+            groups.setdefault(key, []).append((fn, future))
+        for (scope, catalog), jobs in groups.items():
+            with _event_scope(scope):
+                _run_write_group(jobs, catalog=catalog)
+
+
+def _run_write_group(batch: list[tuple[Callable, Future]], *, catalog: bool) -> None:
+    done: list[tuple[Future, object]] = []
+    conn = None
+    try:
+        conn = _db()
+        _begin_write(conn, catalog=catalog)
+        for fn, future in batch:
+            # A savepoint per job: one failing job is undone without losing the others.
+            conn.execute("SAVEPOINT write_job")
+            try:
+                result = fn(conn)
+            except BaseException as exc:
+                conn.execute("ROLLBACK TO write_job")
+                conn.execute("RELEASE write_job")
+                future.set_exception(exc)
+                continue
+            conn.execute("RELEASE write_job")
+            done.append((future, result))
         conn.commit()
+    except BaseException as exc:
+        if isinstance(exc, sqlite3.OperationalError) and ("locked" in str(exc) or "busy" in str(exc)):
+            _metric_inc("attendance_db_busy_total")
+        try:
+            if conn is not None:
+                conn.rollback()
+        except Exception:
+            _close_db()
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+        return
+    _metric_inc("attendance_db_write_batches_total")
+    _metric_inc("attendance_db_write_jobs_total", value=len(done))
+    for future, result in done:
+        future.set_result(result)
 
 
 def _attendance_export_rows(event_id: int, present_only: bool) -> list[dict]:
@@ -158,239 +1381,1581 @@ def _attendance_export_rows(event_id: int, present_only: bool) -> list[dict]:
 
 
 def _attendance_export_rows_for_session(*, event_id: int, session_id: int, present_only: bool) -> list[dict]:
+    return [dict(r) for r in _attendance_export_cursor(event_id=event_id, session_id=session_id, present_only=present_only)]
+
+
+def _attendance_export_cursor(*, event_id: int, session_id: int, present_only: bool) -> sqlite3.Cursor:
+    """Open (but do not fetch) the export query so callers can stream rows off the cursor."""
     session_id = int(session_id or 0)
     if session_id <= 0:
         session_id = _ensure_default_session(event_id)
 
-    with _db() as conn:
-        if present_only:
-            rows = conn.execute(
-                """
-                SELECT s.uid, s.name, s.branch, s.year,
-                       'Present' AS status,
-                       sa.timestamp AS timestamp,
-                       sa.source AS source,
-                       sa.device_id AS device_id
-                  FROM session_attendance sa
-                  JOIN students s
-                    ON s.event_id = sa.event_id AND s.uid = sa.uid
-                 WHERE sa.event_id = ? AND sa.session_id = ?
-                 ORDER BY sa.timestamp DESC, s.name, s.uid
-                """,
-                (event_id, session_id),
-            ).fetchall()
-        else:
-            rows = conn.execute(
-                """
-                SELECT s.uid, s.name, s.branch, s.year,
-                       CASE WHEN sa.uid IS NULL THEN 'Absent' ELSE 'Present' END AS status,
-                       COALESCE(sa.timestamp, '') AS timestamp,
-                       COALESCE(sa.source, 'Imported') AS source,
-                       COALESCE(sa.device_id, '') AS device_id
-                  FROM students s
-                  LEFT JOIN session_attendance sa
-                    ON sa.event_id = s.event_id AND sa.uid = s.uid AND sa.session_id = ?
-                 WHERE s.event_id = ?
-                 ORDER BY s.name, s.uid
-                """,
-                (session_id, event_id),
-            ).fetchall()
+    with _event_scope(event_id):
+        conn = _db()
+    return _export_query(conn, event_id=event_id, session_id=session_id, present_only=present_only)
+
+
+_PRESENT_EXPORT_SQL = """
+    SELECT s.uid, s.name, s.branch, s.year,
+           'Present' AS status,
+           sa.timestamp AS timestamp,
+           sa.source AS source,
+           sa.device_id AS device_id
+      FROM session_attendance sa
+      JOIN students s
+        ON s.event_id = sa.event_id AND s.uid = sa.uid
+     WHERE sa.event_id = ? AND sa.session_id = ?
+     ORDER BY sa.timestamp DESC, s.name, s.uid
+"""
+
+_FULL_EXPORT_SQL = """
+    SELECT s.uid, s.name, s.branch, s.year,
+           CASE WHEN sa.uid IS NULL THEN 'Absent' ELSE 'Present' END AS status,
+           COALESCE(sa.timestamp, '') AS timestamp,
+           COALESCE(sa.source, 'Imported') AS source,
+           COALESCE(sa.device_id, '') AS device_id
+      FROM students s
+      LEFT JOIN session_attendance sa
+        ON sa.event_id = s.event_id AND sa.uid = s.uid AND sa.session_id = ?
+     WHERE s.event_id = ?
+     ORDER BY s.name, s.uid
+"""
+
+
+def _export_query(conn: sqlite3.Connection, *, event_id: int, session_id: int, present_only: bool) -> sqlite3.Cursor:
+    if present_only:
+        return conn.execute(_PRESENT_EXPORT_SQL, (event_id, session_id))
+    return conn.execute(_FULL_EXPORT_SQL, (session_id, event_id))
+
+
+# Standardized export columns (same as live attendance table).
+EXPORT_COLUMNS = (
+    ("uid", "UID"),
+    ("name", "Name"),
+    ("branch", "Branch"),
+    ("year", "Year"),
+    ("status", "Status"),
+    ("timestamp", "Time"),
+    ("source", "Source"),
+    ("device_id", "Device"),
+)
+EXPORT_FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+}
+# Rows buffered per chunk sent by the streaming CSV/NDJSON exports.
+EXPORT_CHUNK_ROWS = 1000
+
+
+def _export_csv_chunks(rows: Iterable[sqlite3.Row]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # BOM so Excel opens the UTF-8 file with the right encoding.
+    buf.write("\ufeff")
+    writer.writerow([label for _, label in EXPORT_COLUMNS])
+    for n, row in enumerate(rows, start=1):
+        writer.writerow([row[key] for key, _ in EXPORT_COLUMNS])
+        if n % EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+    yield buf.getvalue()
+
+
+def _export_ndjson_chunks(rows: Iterable[sqlite3.Row]) -> Iterator[str]:
+    lines: list[str] = []
+    for row in rows:
+        lines.append(json.dumps({key: row[key] for key, _ in EXPORT_COLUMNS}, ensure_ascii=False))
+        if len(lines) >= EXPORT_CHUNK_ROWS:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def _export_xlsx_file(rows: Iterable[sqlite3.Row]) -> IO[bytes]:
+    """Write rows through an openpyxl write-only workbook into a temp file (rewound, caller closes)."""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Attendance")
+    sheet.append([label for _, label in EXPORT_COLUMNS])
+    for row in rows:
+        sheet.append([row[key] for key, _ in EXPORT_COLUMNS])
+    out = tempfile.TemporaryFile()
+    workbook.save(out)
+    out.seek(0)
+    return out
+
+
+# Tables copied into an event archive, in file order. Sessions come from the catalog; the
+# roster goes last, in export order, so a full export can stream it (see _archived_export_rows).
+ARCHIVE_TABLES = (
+    ("sessions", "ORDER BY session_id"),
+    ("session_attendance", "ORDER BY session_id, seq"),
+    ("students", "ORDER BY name, uid"),
+)
+
+# Everything a write to the event changes; archiving only deletes rows if it still matches
+# the snapshot the archive file was written from.
+_ARCHIVE_FINGERPRINT_SQL = """
+    SELECT e.is_active, e.archived_at,
+           (SELECT roster_version || ':' || session_version FROM event_versions WHERE event_id = e.event_id),
+           (SELECT COUNT(*) || ':' || COALESCE(MAX(session_id), 0) FROM sessions WHERE event_id = e.event_id),
+           (SELECT COUNT(*) || ':' || COALESCE(SUM(value), 0) FROM session_counters WHERE event_id = e.event_id)
+      FROM events e
+     WHERE e.event_id = ?
+"""
+
+
+def _archive_path(event_id: int, suffix: str = ".ndjson.gz") -> str:
+    return os.path.join(ARCHIVE_DIR, f"event-{int(event_id)}{suffix}")
+
+
+def _write_archive(conn: sqlite3.Connection, path: str, event: sqlite3.Row, archived_at: str) -> dict[str, int]:
+    """Stream the event into a gzipped NDJSON file at `path` and fsync it. Returns rows per table.
+
+    Line 1 is the header ({"format": 2, "archived_at", "event"}); each table then gets a
+    {"table", "columns"} line followed by one JSON array per row.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    counts = {}
+    with open(path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+
+            def line(value) -> None:
+                gz.write(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+
+            line({"format": 2, "archived_at": archived_at, "event": dict(event)})
+            for table, order in ARCHIVE_TABLES:
+                cur = conn.execute(f"SELECT * FROM {table} WHERE event_id = ? {order}", (event["event_id"],))
+                line({"table": table, "columns": [d[0] for d in cur.description]})
+                counts[table] = 0
+                for row in cur:
+                    line(list(row))
+                    counts[table] += 1
+        raw.flush()
+        os.fsync(raw.fileno())
+    return counts
+
+
+def _archive_event(event_id: int) -> tuple[dict, int]:
+    """Move a closed event's sessions, roster and attendance into ARCHIVE_DIR, then compact.
+
+    The archive is written and fsynced from a read snapshot, without the write lock. The
+    write transaction then only checks that the event is unchanged since that snapshot,
+    renames the file into place and deletes the rows, so /mark is never held up by the
+    copy and the live rows only disappear once their copy is on disk.
+
+    Returns: (response_body, http_status)
+    """
+    path = _archive_path(event_id)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    archived_at = _now_str()
+    with _event_scope(event_id):
+        conn = _db()
+        # One read transaction: the rows written and the fingerprint come from the same snapshot.
+        with conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN")
+            event = conn.execute(_EVENT_SQL, (event_id,)).fetchone()
+            if not event:
+                return {"error": "Invalid event_id"}, 404
+            if event["archived_at"]:
+                return {"error": "Event is already archived"}, 409
+            if event["is_active"]:
+                return {"error": "Close the event before archiving it"}, 409
+            fingerprint = tuple(conn.execute(_ARCHIVE_FINGERPRINT_SQL, (event_id,)).fetchone())
+            try:
+                counts = _write_archive(conn, tmp, event, archived_at)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+        def delete_rows(conn: sqlite3.Connection) -> tuple[dict, int]:
+            if tuple(conn.execute(_ARCHIVE_FINGERPRINT_SQL, (event_id,)).fetchone()) != fingerprint:
+                return {"error": "Event changed while it was being archived; try again"}, 409
+            os.replace(tmp, path)
+            if _FTS_ENABLED:
+                conn.execute(
+                    """
+                    INSERT INTO students_fts (students_fts, rowid, ev, uid, name)
+                    SELECT 'delete', rowid, '#' || event_id || '#', uid, name FROM students WHERE event_id = ?
+                    """,
+                    (event_id,),
+                )
+                # Merge the delete markers away so the index pages are actually freed.
+                conn.execute("INSERT INTO students_fts (students_fts) VALUES ('optimize')")
+            for table in ("session_attendance", "session_counters", "event_versions", "students", "sessions"):
+                conn.execute(f"DELETE FROM {table} WHERE event_id = ?", (event_id,))
+            conn.execute("UPDATE events SET archived_at = ? WHERE event_id = ?", (archived_at, event_id))
+            return {
+                "event_id": event_id,
+                "archive": path,
+                "archive_bytes": os.path.getsize(path),
+                "sessions": counts["sessions"],
+                "students": counts["students"],
+                "scans": counts["session_attendance"],
+            }, 200
+
+        try:
+            body, status = _run_write(delete_rows, catalog=True)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        if status != 200:
+            return body, status
+        with _roster_indexes_lock:
+            _roster_indexes.pop(event_id, None)
+        body["compacted"] = {schema: _compact_database(conn, schema) for schema in _schemas(conn)}
+    app.logger.info("Archived event %s (%s)", event_id, body)
+    return body, 200
+
+
+def _schemas(conn: sqlite3.Connection) -> tuple[str, ...]:
+    return ("main", conn.shard) if getattr(conn, "shard", None) else ("main",)
+
+
+def _compact_database(conn: sqlite3.Connection, schema: str = "main") -> dict:
+    """Return free pages to the filesystem with incremental vacuum.
+
+    A file created before auto_vacuum=INCREMENTAL was enabled is converted by one full
+    VACUUM first (which holds the write lock for the duration). Returns bytes before/after.
+    """
+
+    def size() -> int:
+        page_size = conn.execute(f"PRAGMA {schema}.page_size").fetchone()[0]
+        return int(conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]) * int(page_size)
+
+    before = size()
+    if int(conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0]) != 2:
+        conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+        conn.execute(f"VACUUM {schema}")
+    else:
+        # Small steps, each its own transaction, so scans are never blocked for long.
+        while int(conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]) > 0:
+            conn.execute(f"PRAGMA {schema}.incremental_vacuum({max(ARCHIVE_VACUUM_PAGES, 1)})").fetchall()
+    if SQLITE_JOURNAL_MODE == "WAL":
+        conn.execute(f"PRAGMA {schema}.wal_checkpoint(TRUNCATE)").fetchall()
+    return {"bytes_before": before, "bytes_after": size()}
+
+
+def _archive_records(path: str) -> Iterator[tuple[str, dict]]:
+    """(table, row) for every row of an archive file, in ARCHIVE_TABLES order."""
+    if path.endswith(".ndjson.gz"):
+        with gzip.open(path, "rt", encoding="utf-8") as lines:
+            table, columns = "", []
+            for line in lines:
+                value = json.loads(line)
+                if isinstance(value, list):
+                    yield table, dict(zip(columns, value))
+                elif "table" in value:
+                    table, columns = value["table"], value["columns"]
+        return
+    # Format 1 (one JSON document, written before archives were streamed).
+    with gzip.open(path, "rb") as gz:
+        data = json.loads(gz.read().decode("utf-8"))
+    for table, _ in ARCHIVE_TABLES:
+        columns = data[table]["columns"]
+        rows = [dict(zip(columns, row)) for row in data[table]["rows"]]
+        if table == "students":
+            rows.sort(key=lambda r: (r["name"], r["uid"]))
+        for row in rows:
+            yield table, row
+
+
+def _archived_export_rows(*, event_id: int, session_id: int, present_only: bool) -> Iterator[dict] | None:
+    """Export rows of an archived event, read from its archive file in one pass.
+
+    Same columns and order as _export_query. Only the exported session's attendance is
+    held in memory; the full export streams the roster straight from the file. The
+    session defaults to the newest archived one. Returns None if the archive is missing.
+    """
+    path = next(
+        (p for p in (_archive_path(event_id), _archive_path(event_id, ".json.gz")) if os.path.exists(p)), None
+    )
+    if path is None:
+        return None
+
+    def rows() -> Iterator[dict]:
+        sid, newest = int(session_id or 0), 0
+        attendance: dict[str, dict] = {}
+        present: list[dict] = []
+        for table, row in _archive_records(path):
+            if table == "sessions":
+                newest = max(newest, int(row["session_id"]))
+                continue
+            if sid <= 0:
+                sid = newest
+            if table == "session_attendance":
+                if row["session_id"] == sid:
+                    attendance[row["uid"]] = row
+                continue
+            scan = attendance.get(row["uid"])
+            if present_only and scan is None:
+                continue
+            out = {
+                "uid": row["uid"],
+                "name": row["name"],
+                "branch": row["branch"],
+                "year": row["year"],
+                "status": "Absent" if scan is None else "Present",
+                "timestamp": scan["timestamp"] if scan else "",
+                "source": scan["source"] if scan else "Imported",
+                "device_id": scan["device_id"] if scan else "",
+            }
+            if present_only:
+                present.append(out)
+            else:
+                yield out
+        # Students arrive by (name, uid); a stable sort on timestamp gives the live
+        # ORDER BY timestamp DESC, name, uid.
+        present.sort(key=lambda r: r["timestamp"], reverse=True)
+        yield from present
+
+    return rows()
+
+
+@app.cli.command("archive-events")
+@click.option("--event-id", type=int, default=None, help="Only this event (default: every closed event).")
+def archive_events_command(event_id: int | None) -> None:
+    """Move closed events to ARCHIVE_DIR and compact the live database."""
+    if event_id is None:
+        with _event_scope(None), _db() as conn:
+            event_ids = [
+                int(r[0])
+                for r in conn.execute("SELECT event_id FROM events WHERE is_active = 0 AND archived_at = '' ORDER BY event_id")
+            ]
+    else:
+        event_ids = [event_id]
+    failed = 0
+    for eid in event_ids:
+        body, status = _archive_event(eid)
+        if status != 200:
+            failed += 1
+            click.echo(f"event {eid}: {body['error']}")
+            continue
+        sizes = ", ".join(f"{schema} {c['bytes_before']} -> {c['bytes_after']} bytes" for schema, c in body["compacted"].items())
+        click.echo(f"event {eid}: {body['students']} students, {body['scans']} scans -> {body['archive']} ({sizes})")
+    if failed:
+        raise SystemExit(f"{failed} event(s) not archived.")
+    click.echo(f"Archived {len(event_ids)} event(s).")
+
+
+ROSTER_COLUMNS = ("uid", "name", "branch", "year")
+ROSTER_FILE_TYPES = {".xlsx": "Excel", ".csv": "CSV"}
+
+RosterChunk = list[tuple[str, str, str, str]]
 
-    return [dict(r) for r in rows]
 
+def _roster_file_type(filename: str) -> str | None:
+    name = (filename or "").lower()
+    return next((ext for ext in ROSTER_FILE_TYPES if name.endswith(ext)), None)
 
-def _import_students_from_excel(*, event_id: int, file_storage) -> tuple[int, str | None]:
-    """Import roster rows into students table.
 
-    Returns: (imported_count, error_message)
+def _roster_cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def _open_roster(source, file_type: str) -> tuple[Iterator[RosterChunk] | None, str | None]:
+    """Open an .xlsx/.csv roster for streaming.
+
+    Only the header row is read up front. The returned iterator yields normalized
+    (uid, name, branch, year) tuples in chunks of at most IMPORT_CHUNK_SIZE rows, so
+    memory stays flat regardless of roster size. `source` is a path or binary file object.
+
+    Returns: (chunk_iterator, error_message)
     """
+    label = ROSTER_FILE_TYPES.get(file_type, "Excel")
+    try:
+        if file_type == ".csv":
+            stream = open(source, "rb") if isinstance(source, str) else source
+            text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+            rows = csv.reader(text)
+            close = text.close
+        else:
+            workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            close = workbook.close
+    except Exception as e:
+        return None, f"Unable to read {label}: {e}"
+
+    try:
+        header = [_roster_cell(c).lower() for c in (next(rows, None) or ())]
+    except Exception as e:
+        close()
+        return None, f"Unable to read {label}: {e}"
+    positions = {col: header.index(col) if col in header else None for col in ROSTER_COLUMNS}
+    if positions["uid"] is None or positions["name"] is None:
+        close()
+        return None, f"{label} must have uid and name columns"
+
+    def _chunks() -> Iterator[RosterChunk]:
+        chunk_size = max(IMPORT_CHUNK_SIZE, 1)
+        try:
+            chunk: RosterChunk = []
+            for values in rows:
+                uid, name, branch, year = (
+                    _roster_cell(values[i]) if i is not None and i < len(values) else ""
+                    for i in (positions[col] for col in ROSTER_COLUMNS)
+                )
+                if not uid or not name:
+                    continue
+                chunk.append((uid, name, branch, year))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            close()
+
+    return _chunks(), None
+
+
+def _import_students_from_excel(*, event_id: int, file_storage) -> tuple[int, str | None, dict]:
+    """Import roster rows (.xlsx or .csv) into students table.
+
+    The whole file is parsed into pending_import_rows first, so a read error partway
+    through leaves the roster untouched.
+
+    Returns: (imported_count, error_message, timings_ms)
+    """
+    timings: dict = {}
     if not file_storage:
-        return 0, "file is required"
-    filename = (getattr(file_storage, "filename", "") or "").lower()
-    if not filename.endswith(".xlsx"):
-        return 0, "Excel (.xlsx) file required"
+        return 0, "file is required", timings
+    file_type = _roster_file_type(getattr(file_storage, "filename", "") or "")
+    if not file_type:
+        return 0, "Excel (.xlsx) or CSV (.csv) file required", timings
 
+    chunks, err = _open_roster(file_storage.stream, file_type)
+    if err:
+        return 0, err, timings
+
+    _cleanup_pending_imports(max_age_minutes=60)
+    token = secrets.token_urlsafe(18)
+    t0 = time.perf_counter()
     try:
-        df = pd.read_excel(file_storage)
+        _stage_roster_chunks(token=token, chunks=chunks)
     except Exception as e:
-        return 0, f"Unable to read Excel: {e}"
+        _discard_pending_import(token)
+        return 0, f"Unable to read {ROSTER_FILE_TYPES[file_type]}: {e}", timings
+    timings["read_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    inserted, err = _import_staged_roster(event_id=event_id, token=token, timings=timings)
+    return int(inserted or 0), err, timings
+
+
+_STALE_IMPORT_ROWS_SQL = (
+    "DELETE FROM pending_import_rows WHERE token IN (SELECT token FROM pending_imports WHERE created_at < ?)"
+)
+_STALE_IMPORTS_SQL = "DELETE FROM pending_imports WHERE created_at < ?"
+
+
+def _cleanup_pending_imports(*, max_age_minutes: int = 60) -> None:
+    cutoff = (datetime.now() - timedelta(minutes=max_age_minutes)).strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        with _db() as conn:
+            _begin_write(conn, catalog=True)
+            conn.execute(_STALE_IMPORT_ROWS_SQL, (cutoff,))
+            conn.execute(_STALE_IMPORTS_SQL, (cutoff,))
+            conn.commit()
+    except Exception:
+        return
 
-    # Normalize column names.
-    df.columns = [str(c).strip().lower() for c in df.columns]
-    required = {"uid", "name"}
-    if not required.issubset(set(df.columns)):
-        return 0, "Excel must have uid and name columns"
 
-    inserted = 0
+def _discard_pending_import(token: str) -> None:
     with _db() as conn:
-        for _, row in df.iterrows():
-            uid = str(row.get("uid", "")).strip()
-            name = str(row.get("name", "")).strip()
-            branch = str(row.get("branch", "")).strip()
-            year = str(row.get("year", "")).strip()
-            if not uid or not name:
-                continue
-            conn.execute(
-                """
-                INSERT OR REPLACE INTO students
-                    (event_id, uid, name, branch, year, status, timestamp, source, device_id, device_timestamp)
-                VALUES
-                    (?, ?, ?, ?, ?, 'Absent', '', 'Imported', '', '')
-                """,
-                (event_id, uid, name, branch, year),
-            )
-            inserted += 1
+        _begin_write(conn, catalog=True)
+        conn.execute("DELETE FROM pending_import_rows WHERE token = ?", (token,))
+        conn.execute("DELETE FROM pending_imports WHERE token = ?", (token,))
         conn.commit()
 
-    return inserted, None
 
+def _stage_roster_chunks(*, token: str, chunks: Iterable[RosterChunk]) -> tuple[list[dict], int]:
+    """Parse an upload once into pending_import_rows, keeping the first IMPORT_PREVIEW_ROWS for display.
+
+    Returns: (preview_rows, total_valid_rows)
+    """
+    rows: list[dict] = []
+    count = 0
+    for chunk in chunks:
+        params = [(token, count + i, *values) for i, values in enumerate(chunk)]
+        _run_write(
+            lambda conn, params=params: conn.executemany(
+                "INSERT INTO pending_import_rows (token, seq, uid, name, branch, year) VALUES (?, ?, ?, ?, ?, ?)",
+                params,
+            ),
+            catalog=True,
+        )
+        count += len(chunk)
+        for values in chunk[: max(IMPORT_PREVIEW_ROWS - len(rows), 0)]:
+            rows.append(dict(zip(ROSTER_COLUMNS, values)))
+
+    _run_write(
+        lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO pending_imports (token, row_count, created_at) VALUES (?, ?, ?)",
+            (token, count, _now_str()),
+        ),
+        catalog=True,
+    )
+    return rows, count
 
-def _pending_import_path(token: str) -> str:
-    safe = "".join(ch for ch in (token or "") if ch.isalnum() or ch in ("-", "_"))
-    return os.path.join(UPLOAD_FOLDER, f"pending_import_{safe}.xlsx")
 
+_STAGED_UIDS_SQL = "SELECT uid FROM pending_import_rows WHERE token = ? AND seq >= ? AND seq < ?"
 
-def _cleanup_pending_imports(*, max_age_minutes: int = 60) -> None:
+# seq order keeps "last duplicate UID in the file wins".
+_STAGED_COPY_SQL = """
+    INSERT OR REPLACE INTO students
+        (event_id, uid, name, branch, year, status, timestamp, source, device_id, device_timestamp,
+         roster_version)
+    SELECT ?, uid, name, branch, year, 'Absent', '', 'Imported', '', '', ?
+      FROM pending_import_rows
+     WHERE token = ? AND seq >= ? AND seq < ?
+     ORDER BY seq
+"""
+
+
+def _import_staged_roster(*, event_id: int, token: str, timings: dict) -> tuple[int | None, str | None]:
+    """Copy a staged roster into students in IMPORT_CHUNK_SIZE slices, then drop the staging rows.
+
+    Each slice is its own transaction, so scans are not held up behind a big roster. If a
+    slice fails, the staging rows are kept (confirming the same token again redoes the
+    copy; re-imported rows are replaced, not duplicated) and the error says how many rows
+    are already in.
+
+    Returns: (imported_count, error_message); the count is None if the token is unknown/expired.
+    """
+    chunk_size = max(IMPORT_CHUNK_SIZE, 1)
+    t0 = time.perf_counter()
+    with _db() as conn:
+        row = conn.execute("SELECT row_count FROM pending_imports WHERE token = ?", (token,)).fetchone()
+    if not row:
+        return None, None
+    row_count = int(row[0])
+
+    def copy_slice(conn: sqlite3.Connection, start: int) -> None:
+        uids = [
+            r[0]
+            for r in conn.execute(_STAGED_UIDS_SQL, (token, start, start + chunk_size))
+        ]
+        version = _bump_event_versions(conn, event_id, roster=True)
+        _bump_session_counters(conn, event_id, 0, {"total": _count_new_uids(conn, event_id, uids)})
+        _fts_unindex(conn, event_id, uids)
+        conn.execute(_STAGED_COPY_SQL, (event_id, version, token, start, start + chunk_size))
+        _fts_index(conn, event_id, uids)
+
+    for start in range(0, row_count, chunk_size):
+        try:
+            _run_write(lambda conn, start=start: copy_slice(conn, start))
+        except Exception as e:
+            app.logger.exception("Roster import into event %s stopped after %d of %d rows", event_id, start, row_count)
+            return start, f"Import stopped after {start} of {row_count} rows: {e}. Retry to finish it."
+
+    _discard_pending_import(token)
+    timings["write_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    app.logger.info("Imported %d staged students into event %s (%s)", row_count, event_id, timings)
+    return row_count, None
+
+
+_EVENT_SQL = "SELECT * FROM events WHERE event_id = ?"
+
+
+def _get_event(event_id: int) -> dict | None:
+    with _db() as conn:
+        row = conn.execute(_EVENT_SQL, (event_id,)).fetchone()
+        return dict(row) if row else None
+
+
+def _require_event_id() -> int | None:
+    raw = request.args.get("event_id") or request.form.get("event_id")
+    if raw is None:
+        return None
     try:
-        cutoff = datetime.now() - timedelta(minutes=max_age_minutes)
-        for name in os.listdir(UPLOAD_FOLDER):
-            if not name.startswith("pending_import_") or not name.endswith(".xlsx"):
-                continue
-            path = os.path.join(UPLOAD_FOLDER, name)
+        eid = int(raw)
+    except ValueError:
+        return None
+    return eid if eid > 0 else None
+
+
+_EVENT_SESSIONS_SQL = "SELECT * FROM sessions WHERE event_id = ? ORDER BY session_id DESC"
+_ACTIVE_SESSION_SQL = "SELECT * FROM sessions WHERE event_id = ? AND is_active = 1 ORDER BY session_id DESC LIMIT 1"
+_NEWEST_SESSION_SQL = "SELECT session_id FROM sessions WHERE event_id = ? ORDER BY session_id DESC LIMIT 1"
+
+
+def _get_sessions(event_id: int) -> list[dict]:
+    with _db() as conn:
+        rows = conn.execute(_EVENT_SESSIONS_SQL, (event_id,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def _get_active_session(event_id: int) -> dict | None:
+    with _db() as conn:
+        row = conn.execute(_ACTIVE_SESSION_SQL, (event_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def _ensure_default_session(event_id: int) -> int:
+    active = _get_active_session(event_id)
+    if active:
+        return int(active.get("session_id") or 0)
+
+    with _event_scope(event_id):
+        return _run_write(lambda conn: _activate_default_session(conn, event_id), catalog=True)
+
+
+_EVENT_ARCHIVED_SQL = "SELECT 1 FROM events WHERE event_id = ? AND archived_at != ''"
+
+
+def _activate_default_session(conn: sqlite3.Connection, event_id: int) -> int:
+    """Re-open the newest session for the event, or create "Session 1" (caller commits).
+
+    Returns 0 for an archived event (its sessions live in the archive).
+    """
+    if conn.execute(_EVENT_ARCHIVED_SQL, (event_id,)).fetchone():
+        return 0
+    row = conn.execute(_NEWEST_SESSION_SQL, (event_id,)).fetchone()
+    _bump_event_versions(conn, event_id, session=True)
+    if row:
+        sid = int(row[0])
+        conn.execute("UPDATE sessions SET is_active = 1 WHERE session_id = ?", (sid,))
+        return sid
+
+    conn.execute(
+        "INSERT INTO sessions (event_id, session_name, is_active, created_at) VALUES (?, ?, 1, ?)",
+        (event_id, "Session 1", _now_str()),
+    )
+    return int(conn.execute("SELECT last_insert_rowid() AS id").fetchone()[0])
+
+
+def _reset_event_roster_for_new_session(event_id: int) -> None:
+    """Reset per-student attendance fields so a new session can be taken for the same event.
+
+    Note: This does not preserve historical sessions; it simply starts a fresh run.
+    """
+    with _db() as conn:
+        conn.execute(
+            """
+            UPDATE students
+               SET status = 'Absent',
+                   timestamp = '',
+                   source = 'Imported',
+                   device_id = '',
+                   device_timestamp = ''
+             WHERE event_id = ?
+            """,
+            (event_id,),
+        )
+        _bump_event_versions(conn, event_id, session=True)
+        conn.commit()
+
+
+# Arrival-rate minute of a session_attendance row (SQL twin of _scan_minute).
+_SCAN_MINUTE_EXPR = """
+    substr(CASE WHEN device_timestamp GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]*'
+                 AND device_timestamp <= timestamp
+                THEN device_timestamp ELSE timestamp END, 1, 16)
+"""
+
+# Counter values recomputed from the source tables (same rows session_counters should hold).
+_COMPUTED_COUNTERS_SQL = f"""
+    SELECT event_id, 0 AS session_id, 'total' AS name, COUNT(*) AS value
+      FROM students GROUP BY event_id
+    UNION ALL
+    SELECT event_id, session_id, 'present', COUNT(*)
+      FROM session_attendance GROUP BY event_id, session_id
+    UNION ALL
+    SELECT event_id, session_id, 'source:' || source, COUNT(*)
+      FROM session_attendance GROUP BY event_id, session_id, source
+    UNION ALL
+    SELECT event_id, session_id, 'device:' || device_id, COUNT(*)
+      FROM session_attendance WHERE device_id != '' GROUP BY event_id, session_id, device_id
+    UNION ALL
+    SELECT event_id, session_id, 'minute:' || {_SCAN_MINUTE_EXPR}, COUNT(*)
+      FROM session_attendance GROUP BY event_id, session_id, {_SCAN_MINUTE_EXPR}
+    UNION ALL
+    SELECT event_id, session_id, 'device_minute:' || {_SCAN_MINUTE_EXPR} || '|' || device_id, COUNT(*)
+      FROM session_attendance WHERE device_id != ''
+     GROUP BY event_id, session_id, {_SCAN_MINUTE_EXPR}, device_id
+"""
+
+
+_COUNTER_BUMP_SQL = """
+    INSERT INTO session_counters (event_id, session_id, name, value) VALUES (?, ?, ?, ?)
+    ON CONFLICT(event_id, session_id, name) DO UPDATE SET value = value + excluded.value
+"""
+_COUNTER_RANGE_SQL = """
+    SELECT name, value FROM session_counters
+     WHERE event_id = ? AND session_id = ? AND name >= ? AND name < ? AND value != 0
+"""
+_SESSION_COUNTS_SQL = """
+    SELECT name, value FROM session_counters
+     WHERE event_id = ? AND ((session_id = 0 AND name = 'total') OR (session_id = ? AND name = 'present'))
+"""
+
+
+def _bump_session_counters(conn: sqlite3.Connection, event_id: int, session_id: int, deltas: dict[str, int]) -> None:
+    """Add `deltas` ({counter name: change}) to the session's counters (caller commits)."""
+    conn.executemany(
+        _COUNTER_BUMP_SQL,
+        [(event_id, session_id, name, delta) for name, delta in deltas.items() if delta],
+    )
+
+
+def _session_counter_values(
+    conn: sqlite3.Connection, *, event_id: int, session_id: int, prefix: str, start: str = ""
+) -> dict[str, int]:
+    """Non-zero counters of the session whose name starts with `prefix` (prefix stripped).
+
+    `start`: only names >= prefix + start (e.g. minute buckets from a given minute on).
+    """
+    return {
+        r[0][len(prefix):]: int(r[1])
+        for r in conn.execute(_COUNTER_RANGE_SQL, (event_id, session_id, prefix + start, prefix + "\uffff"))
+    }
+
+
+def _arrival_rates(conn: sqlite3.Connection, *, event_id: int, session_id: int, minutes: int) -> dict:
+    """Scans per minute (overall and per device) for the last `minutes` minutes, plus the session peak.
+
+    Read from the "minute:" / "device_minute:" counters that every scan bumps, so the
+    cost depends on the session's length in minutes, not on how many scans it has.
+    """
+    now = datetime.now().replace(second=0, microsecond=0)
+    window = [(now - timedelta(minutes=n)).strftime("%Y-%m-%d %H:%M") for n in range(minutes - 1, -1, -1)]
+    per_minute = _session_counter_values(conn, event_id=event_id, session_id=session_id, prefix="minute:")
+    per_device: dict[str, dict[str, int]] = {}
+    for name, value in _session_counter_values(
+        conn, event_id=event_id, session_id=session_id, prefix="device_minute:", start=window[0]
+    ).items():
+        minute, _, device_id = name.partition("|")
+        per_device.setdefault(device_id, {})[minute] = value
+
+    peak = max(per_minute.items(), key=lambda item: (item[1], item[0]), default=None)
+    devices = [
+        {
+            "device_id": device_id,
+            "scans": sum(counts.values()),
+            "scans_per_minute": [counts.get(minute, 0) for minute in window],
+        }
+        for device_id, counts in per_device.items()
+    ]
+    devices.sort(key=lambda d: (-d["scans"], d["device_id"]))
+    return {
+        "minutes": window,
+        "scans_per_minute": [per_minute.get(minute, 0) for minute in window],
+        "devices": devices,
+        "peak": {"minute": peak[0], "scans": peak[1]} if peak else None,
+    }
+
+
+def _read_session_counts(conn: sqlite3.Connection, *, event_id: int, session_id: int) -> dict:
+    rows = dict(conn.execute(_SESSION_COUNTS_SQL, (event_id, session_id)).fetchall())
+    total, present = int(rows.get("total", 0)), int(rows.get("present", 0))
+    return {"total": total, "present": present, "remaining": max(total - present, 0), "total_scanned": present}
+
+
+def _rebuild_session_counters(conn: sqlite3.Connection, event_id: int | None = None) -> None:
+    """Recompute session_counters from students/session_attendance (all events, or one; caller commits)."""
+    where = "" if event_id is None else "WHERE event_id = ?"
+    params = () if event_id is None else (event_id,)
+    _begin_write(conn)
+    conn.execute(f"DELETE FROM session_counters {where}", params)
+    conn.execute(
+        f"""
+        INSERT INTO session_counters (event_id, session_id, name, value)
+        SELECT event_id, session_id, name, value FROM ({_COMPUTED_COUNTERS_SQL}) {where}
+        """,
+        params,
+    )
+
+
+def _verify_session_counters(conn: sqlite3.Connection, event_id: int | None = None) -> list[dict]:
+    """Counters whose stored value differs from a recount (empty list when there is no drift)."""
+    where = "" if event_id is None else "WHERE event_id = ?"
+    rows = conn.execute(
+        f"""
+        SELECT event_id, session_id, name, SUM(stored) AS stored, SUM(actual) AS actual
+          FROM (
+                SELECT event_id, session_id, name, value AS stored, 0 AS actual FROM session_counters
+                UNION ALL
+                SELECT event_id, session_id, name, 0, value FROM ({_COMPUTED_COUNTERS_SQL})
+               )
+         {where}
+         GROUP BY event_id, session_id, name
+        HAVING SUM(stored) != SUM(actual)
+         ORDER BY event_id, session_id, name
+        """,
+        () if event_id is None else (event_id,),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+@app.cli.command("counters")
+@click.option("--event-id", type=int, default=None, help="Only this event (default: all).")
+@click.option("--rebuild", is_flag=True, help="Recompute the counters instead of only checking them.")
+def counters_command(event_id: int | None, rebuild: bool) -> None:
+    """Verify (or --rebuild) the materialized session counters."""
+    drift = []
+    for scope in [event_id] if EVENT_SHARDS and event_id else _event_scopes():
+        with _event_scope(scope), _db() as conn:
+            if rebuild:
+                _rebuild_session_counters(conn, event_id)
+                conn.commit()
+            else:
+                drift += _verify_session_counters(conn, event_id)
+    if rebuild:
+        click.echo("Counters rebuilt.")
+        return
+    for row in drift:
+        click.echo(
+            f"event {row['event_id']} session {row['session_id']} {row['name']}: "
+            f"stored {row['stored']}, actual {row['actual']}"
+        )
+    if drift:
+        raise SystemExit(f"{len(drift)} counter(s) drifted; run with --rebuild to fix.")
+    click.echo("Counters OK.")
+
+
+def _roster_counts(event_id: int) -> dict:
+    # Backwards-compatible wrapper (defaults to active session).
+    active = _get_active_session(event_id)
+    session_id = int(active.get("session_id") or 0) if active else 0
+    return _session_counts(event_id=event_id, session_id=session_id)
+
+
+def _session_counts(*, event_id: int, session_id: int) -> dict:
+    session_id = int(session_id or 0)
+    if session_id <= 0:
+        session_id = _ensure_default_session(event_id)
+
+    with _event_scope(event_id), _db() as conn:
+        return _read_session_counts(conn, event_id=event_id, session_id=session_id)
+
+
+def _parse_since() -> int | None:
+    raw = request.args.get("since")
+    try:
+        since = int(raw) if raw not in (None, "") else None
+    except ValueError:
+        return None
+    return since if since is not None and since >= 0 else None
+
+
+_FEED_CURSOR_SQL = "SELECT COALESCE(MAX(seq), 0) FROM session_attendance WHERE event_id = ? AND session_id = ?"
+
+# LIMIT -1 means no limit.
+_FEED_SQL = """
+    SELECT s.uid, s.name, s.branch, s.year,
+           'Present' AS status,
+           sa.timestamp AS timestamp,
+           sa.source AS source,
+           sa.device_id AS device_id,
+           sa.seq AS seq
+      FROM session_attendance sa
+      JOIN students s
+        ON s.event_id = sa.event_id AND s.uid = sa.uid
+     WHERE sa.event_id = ? AND sa.session_id = ? AND sa.seq > ?
+     ORDER BY sa.seq DESC
+     LIMIT ?
+"""
+
+
+def _session_attendance_feed(
+    conn: sqlite3.Connection, *, event_id: int, session_id: int, since: int | None, limit: int | None = None
+) -> tuple[list[dict], int, bool]:
+    """Marked rows for a session, newest first, optionally only those after cursor `since`.
+
+    Returns: (rows, cursor, is_delta). A cursor ahead of the session's latest seq (e.g. the
+    session was switched) falls back to a full listing, so clients can simply replace. So
+    does a delta with more than `limit` new rows, which could not carry them all.
+    """
+    cursor = int(conn.execute(_FEED_CURSOR_SQL, (event_id, session_id)).fetchone()[0])
+    delta = since is not None and since <= cursor
+    if delta and since == cursor:
+        return [], cursor, True
+
+    rows = conn.execute(_FEED_SQL, (event_id, session_id, since if delta else -1, limit + 1 if limit else -1)).fetchall()
+    if limit and len(rows) > limit:
+        # The newest `limit` rows overall: a complete listing, not a delta.
+        rows, delta = rows[:limit], False
+    return [dict(r) for r in rows], cursor, delta
+
+
+def _live_snapshot(
+    conn: sqlite3.Connection, event_id: int, *, session_id: int | None = None, since: int | None = None
+) -> dict | None:
+    """The /api/event/<id>/live payload for the event's open session (read-only).
+
+    `since` only applies when `session_id` is still the open session; otherwise the
+    attendance list is a full (latest STREAM_ROWS) listing with delta=False.
+    """
+    event = conn.execute(_EVENT_SQL, (event_id,)).fetchone()
+    if not event:
+        return None
+    row = conn.execute(_ACTIVE_SESSION_SQL, (event_id,)).fetchone()
+    active_id = int(row["session_id"]) if row else 0
+    rows, cursor, delta = _session_attendance_feed(
+        conn,
+        event_id=event_id,
+        session_id=active_id,
+        since=since if session_id == active_id else None,
+        limit=STREAM_ROWS,
+    )
+    return {
+        "server_time": _now_str(),
+        "event": dict(event),
+        "session_id": active_id,
+        "attendance": rows,
+        "cursor": cursor,
+        "delta": delta,
+        **_read_session_counts(conn, event_id=event_id, session_id=active_id),
+    }
+
+
+# SSE fan-out: one broadcaster thread per worker process notices commits (its own
+# PRAGMA data_version changes whenever any connection, in any worker, commits), builds
+# one payload per watched event and hands it to every subscriber queue in the process.
+# Idle viewers therefore cost no queries; writers in this process wake it immediately.
+_stream_lock = threading.Lock()
+_stream_subscribers: dict[int, set[queue.SimpleQueue]] = {}
+_stream_wakeup = threading.Event()
+_stream_thread_pid: list[int] = []
+_stream_slots = threading.BoundedSemaphore(STREAM_MAX_PER_WORKER) if STREAM_MAX_PER_WORKER > 0 else None
+
+
+def _stream_notify() -> None:
+    _stream_wakeup.set()
+
+
+def _stream_subscribe(event_id: int, q: queue.SimpleQueue) -> None:
+    with _stream_lock:
+        _stream_subscribers.setdefault(event_id, set()).add(q)
+        if _stream_thread_pid != [os.getpid()]:
+            _stream_thread_pid[:] = [os.getpid()]
+            threading.Thread(target=_stream_broadcaster, name="live-stream", daemon=True).start()
+    _stream_notify()
+
+
+def _stream_unsubscribe(event_id: int, q: queue.SimpleQueue) -> None:
+    with _stream_lock:
+        queues = _stream_subscribers.get(event_id)
+        if queues is not None:
+            queues.discard(q)
+            if not queues:
+                del _stream_subscribers[event_id]
+
+
+def _stream_broadcaster() -> None:
+    last_versions: dict[int, tuple[int, int]] = {}
+    published: dict[int, dict] = {}
+    while True:
+        _stream_wakeup.wait(STREAM_POLL_SECONDS)
+        _stream_wakeup.clear()
+        with _stream_lock:
+            watched = {event_id: list(queues) for event_id, queues in _stream_subscribers.items()}
+        for event_id in list(published):
+            if event_id not in watched:
+                del published[event_id]
+                last_versions.pop(event_id, None)
+        if not watched:
+            continue
+
+        try:
+            for event_id, queues in watched.items():
+                prev = published.get(event_id)
+                with _event_scope(event_id):
+                    conn = _db()
+                    # With EVENT_SHARDS, commits to other events' files don't wake this one.
+                    version = _data_version(conn)
+                    if prev is not None and last_versions.get(event_id) == version:
+                        continue
+                    last_versions[event_id] = version
+                    payload = _live_snapshot(
+                        conn,
+                        event_id,
+                        session_id=prev["session_id"] if prev else None,
+                        since=prev["cursor"] if prev else None,
+                    )
+                if payload is None:
+                    continue
+                published[event_id] = payload
+                # Subscribers send their own snapshot first, so a newly watched event
+                # only establishes the baseline.
+                if prev is None:
+                    continue
+                changed = (
+                    payload["attendance"]
+                    or not payload["delta"]
+                    or any(payload[k] != prev[k] for k in ("total", "present", "event"))
+                )
+                if changed:
+                    message = {**payload, "since": prev["cursor"]}
+                    for q in queues:
+                        q.put(message)
+        except sqlite3.Error:
+            last_versions.clear()
+            _close_db()
+            time.sleep(STREAM_POLL_SECONDS)
+
+
+def _parse_stream_id(raw: str | None) -> tuple[int | None, int | None]:
+    """Parse an SSE event id ("<session_id>:<cursor>") sent back as Last-Event-ID."""
+    try:
+        session_id, cursor = (int(part) for part in str(raw or "").split(":", 1))
+    except ValueError:
+        return None, None
+    return session_id, cursor
+
+
+def _sse(payload: dict) -> str:
+    return (
+        f"id: {payload['session_id']}:{payload['cursor']}\n"
+        f"event: live\n"
+        f"data: {json.dumps(payload, separators=(',', ':'))}\n\n"
+    )
+
+
+def _stream_message_for(message: dict, *, session_id: int, cursor: int) -> dict | None:
+    """Tailor a broadcast message to a subscriber at (session_id, cursor).
+
+    Returns None when the subscriber has to catch up with its own _live_snapshot first.
+    """
+    if not message["delta"]:
+        return {k: v for k, v in message.items() if k != "since"}
+    if message["session_id"] != session_id or message["since"] > cursor:
+        return None
+    # Shared delta: drop rows this subscriber has already been sent.
+    rows = [r for r in message["attendance"] if r["seq"] > cursor]
+    tailored = {k: v for k, v in message.items() if k != "since"}
+    return {**tailored, "attendance": rows, "cursor": max(message["cursor"], cursor)}
+
+
+def _live_stream(event_id: int, *, session_id: int | None, since: int | None) -> Iterator[str]:
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    # Subscribe before the first snapshot so no commit can fall between the two.
+    _stream_subscribe(event_id, q)
+    try:
+        with _event_scope(event_id), _db() as conn:
+            payload = _live_snapshot(conn, event_id, session_id=session_id, since=since)
+        if payload is None:
+            return
+        yield f"retry: 3000\n{_sse(payload)}"
+        session_id, cursor = payload["session_id"], payload["cursor"]
+
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
             try:
-                mtime = datetime.fromtimestamp(os.path.getmtime(path))
-                if mtime < cutoff:
-                    os.remove(path)
-            except Exception:
+                message = q.get(timeout=STREAM_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
                 continue
-    except Exception:
-        return
+
+            message = _stream_message_for(message, session_id=session_id, cursor=cursor)
+            if message is None:
+                # The delta starts past what this subscriber has seen: catch up on its own.
+                with _event_scope(event_id), _db() as conn:
+                    message = _live_snapshot(conn, event_id, session_id=session_id, since=cursor)
+                if message is None:
+                    return
+            session_id, cursor = message["session_id"], message["cursor"]
+            yield _sse(message)
+    finally:
+        _stream_unsubscribe(event_id, q)
+
+
+STUDENT_COLUMNS = (
+    "event_id",
+    "uid",
+    "name",
+    "branch",
+    "year",
+    "status",
+    "timestamp",
+    "source",
+    "device_id",
+    "device_timestamp",
+)
+
+# event_id -> {"versions", "event_active", "session_id", "students": {uid: row tuple}, "present": {uid}}
+_roster_indexes: OrderedDict[int, dict] = OrderedDict()
+_roster_indexes_lock = threading.Lock()
+# event_id -> lock held while one thread refreshes or (re)loads that event's index.
+_roster_index_loads: dict[int, threading.Lock] = {}
+
+
+_EVENT_VERSIONS_BUMP_SQL = """
+    INSERT INTO event_versions (event_id, roster_version, session_version) VALUES (?, ?, ?)
+    ON CONFLICT(event_id) DO UPDATE SET
+        roster_version = roster_version + excluded.roster_version,
+        session_version = session_version + excluded.session_version
+    RETURNING roster_version
+"""
+_EVENT_VERSIONS_SQL = "SELECT roster_version, session_version FROM event_versions WHERE event_id = ?"
+
+# One row: the event's open flag, cached-index versions and active session.
+_ROSTER_INDEX_EVENT_SQL = """
+    SELECT e.is_active,
+           COALESCE(v.roster_version, 0) AS roster_version,
+           COALESCE(v.session_version, 0) AS session_version,
+           (SELECT ss.session_id
+              FROM sessions ss
+             WHERE ss.event_id = e.event_id AND ss.is_active = 1
+             ORDER BY ss.session_id DESC
+             LIMIT 1) AS session_id
+      FROM events e
+      LEFT JOIN event_versions v ON v.event_id = e.event_id
+     WHERE e.event_id = ?
+"""
+_ROSTER_INDEX_SQL = f"SELECT {', '.join(STUDENT_COLUMNS)} FROM students WHERE event_id = ?"
+_ROSTER_INDEX_DELTA_SQL = f"SELECT {', '.join(STUDENT_COLUMNS)} FROM students WHERE event_id = ? AND roster_version > ?"
+
+
+def _bump_event_versions(conn: sqlite3.Connection, event_id: int, *, roster: bool = False, session: bool = False) -> int:
+    """Mark cached roster indexes for the event stale in every worker (caller commits).
+
+    `roster`: students were added/replaced (rows written in the same transaction carry
+    the returned version in students.roster_version); indexes catch up on just those rows.
+    `session`: the active session, the event's open/closed state or students' present
+    flags were reset; indexes are reloaded.
+
+    Returns: the event's roster version after the bump.
+    """
+    version = conn.execute(_EVENT_VERSIONS_BUMP_SQL, (event_id, int(roster), int(session))).fetchone()[0]
+    if session:
+        with _roster_indexes_lock:
+            _roster_indexes.pop(event_id, None)
+    # Other threads notice via PRAGMA data_version; this thread's own commit doesn't change it.
+    getattr(_conn_local, "roster_checked", {}).pop(event_id, None)
+    return int(version)
+
+
+def _load_roster_index(conn: sqlite3.Connection, event_id: int) -> dict | None:
+    # One read transaction so versions, session and roster come from the same snapshot.
+    with conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        event = conn.execute(_ROSTER_INDEX_EVENT_SQL, (event_id,)).fetchone()
+        if not event:
+            return None
+        index = {
+            "versions": (int(event["roster_version"]), int(event["session_version"])),
+            "event_active": bool(event["is_active"]),
+            "session_id": int(event["session_id"] or 0),
+            "students": {},
+            "present": set(),
+        }
+        if index["event_active"]:
+            for row in conn.execute(_ROSTER_INDEX_SQL, (event_id,)):
+                uid = row[1]
+                index["students"][uid] = tuple(row)
+                if str(row[5] or "").lower() == "present":
+                    index["present"].add(uid)
+    return index
+
+
+def _catch_up_roster_index(conn: sqlite3.Connection, event_id: int, index: dict) -> bool:
+    """Bring `index` up to the event's current versions in place.
+
+    Students are only ever upserted, each stamped with the roster version of its write, so
+    a roster-only bump is caught up by reading the rows above the index's version.
+
+    Returns: False when the session version moved and the index has to be reloaded.
+    """
+    with conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        row = conn.execute(_EVENT_VERSIONS_SQL, (event_id,)).fetchone()
+        versions = (int(row[0]), int(row[1])) if row else (0, 0)
+        if versions == index["versions"]:
+            return True
+        if versions[1] != index["versions"][1] or versions[0] < index["versions"][0]:
+            return False
+        rows = []
+        if index["event_active"]:
+            rows = conn.execute(_ROSTER_INDEX_DELTA_SQL, (event_id, index["versions"][0])).fetchall()
+    with _roster_indexes_lock:
+        for row in rows:
+            uid = row[1]
+            index["students"][uid] = tuple(row)
+            if str(row[5] or "").lower() == "present":
+                index["present"].add(uid)
+            else:
+                index["present"].discard(uid)
+        index["versions"] = versions
+    return True
+
+
+def _roster_index(event_id: int) -> dict | None:
+    """Return the in-memory roster index for the event, loading or refreshing it lazily.
+
+    Validity check is `PRAGMA data_version` on this thread's connection (no I/O); only
+    when another connection has committed since the last check do we re-read the
+    event's versions. A roster change is applied in place; only a session change (or a
+    cold cache) reloads the roster, and one thread per event does that while the others wait.
+    """
+    with _event_scope(event_id):
+        return _roster_index_scoped(event_id)
+
+
+def _roster_index_scoped(event_id: int) -> dict | None:
+    conn = _db()
+    data_version = _data_version(conn)
+    checked = _conn_local.__dict__.setdefault("roster_checked", {})
+    with _roster_indexes_lock:
+        index = _roster_indexes.get(event_id)
+        load_lock = _roster_index_loads.setdefault(event_id, threading.Lock())
+    if index is not None and checked.get(event_id) == data_version:
+        return index
+
+    with load_lock:
+        # Re-read: another thread may have loaded or caught up the index while this one waited.
+        with _roster_indexes_lock:
+            index = _roster_indexes.get(event_id)
+        if index is None or not _catch_up_roster_index(conn, event_id, index):
+            index = _load_roster_index(conn, event_id)
+            if index is None:
+                return None
+            with _roster_indexes_lock:
+                _roster_indexes[event_id] = index
+                _roster_indexes.move_to_end(event_id)
+                while len(_roster_indexes) > max(ROSTER_CACHE_EVENTS, 1):
+                    _roster_indexes.popitem(last=False)
+    checked[event_id] = data_version
+    return index
+
+
+def _roster_index_mark_present(
+    event_id: int, student: dict, *, index: dict | None, session_id: int | None = None, added: bool = False
+) -> None:
+    """Record our own committed mark in `index`, the roster index read before the write.
+
+    Presence only grows within a session, so this is safe as long as `index` is still the
+    cached one and (when known) is for the session the mark went into. An index reloaded
+    meanwhile, e.g. for a newly opened session, is left alone: the mark may belong to the
+    old session, and a stray UID would get a false "Already marked" until the next reload.
+    `added`: the student came from /add and may not be in the index yet.
+    """
+    uid = student.get("uid")
+    with _roster_indexes_lock:
+        if index is None or _roster_indexes.get(event_id) is not index:
+            return
+        if session_id is not None and index["session_id"] != session_id:
+            return
+        if uid in index["students"] or (added and index["event_active"]):
+            index["students"][uid] = tuple(student.get(col) for col in STUDENT_COLUMNS)
+            index["present"].add(uid)
+
+
+_STUDENT_SQL = "SELECT * FROM students WHERE event_id = ? AND uid = ? LIMIT 1"
+
+_MARK_PRESENT_SQL = """
+    UPDATE students
+       SET status = 'Present',
+           timestamp = ?,
+           source = 'Scanned',
+           device_id = ?,
+           device_timestamp = ?
+     WHERE event_id = ? AND uid = ? AND lower(status) != 'present'
+    RETURNING *
+"""
+
+
+def _mark_student_present(
+    conn: sqlite3.Connection,
+    *,
+    event_id: int,
+    session_id: int,
+    uid: str,
+    device_id: str,
+    device_timestamp: str,
+    now: str,
+) -> tuple[dict, int]:
+    """Mark a scanned UID present on an open connection (caller commits).
+
+    The UPDATE only matches a student that is not yet present, so whether it returned a
+    row decides between success and 409 without a separate check-then-act read.
+
+    Returns: (response_body, http_status)
+    """
+    updated = conn.execute(_MARK_PRESENT_SQL, (now, device_id, device_timestamp, event_id, uid)).fetchone()
+    if not updated:
+        row = conn.execute(_STUDENT_SQL, (event_id, uid)).fetchone()
+        if not row:
+            return {"error": "Invalid UID"}, 404
+        return {"error": "Already marked", "student": dict(row)}, 409
+
+    # Record per-session attendance (history).
+    _record_session_attendance(
+        conn,
+        event_id=event_id,
+        session_id=session_id,
+        uid=uid,
+        now=now,
+        source="Scanned",
+        device_id=device_id,
+        device_timestamp=device_timestamp,
+    )
+    return {"success": True, "timestamp": now, "student": dict(updated)}, 200
+
+
+_SCAN_EVENT_SQL = """
+    SELECT e.is_active,
+           (SELECT ss.session_id
+              FROM sessions ss
+             WHERE ss.event_id = e.event_id AND ss.is_active = 1
+             ORDER BY ss.session_id DESC
+             LIMIT 1) AS session_id
+      FROM events e
+     WHERE e.event_id = ?
+"""
+
+
+def _mark_scan(conn: sqlite3.Connection, *, event_id: int, uid: str, device_id: str, device_timestamp: str) -> tuple[dict, int]:
+    """Resolve event + session, flush buffered device heartbeats and mark the student (caller commits).
+
+    Returns: (response_body, http_status)
+    """
+    event = conn.execute(_SCAN_EVENT_SQL, (event_id,)).fetchone()
+    if not event:
+        return {"error": "Invalid event_id"}, 404
+
+    _flush_device_heartbeats(conn)
+    if not bool(event["is_active"]):
+        return {"error": "Event is closed"}, 403
+
+    session_id = int(event["session_id"] or 0) or _activate_default_session(conn, event_id)
+    if session_id <= 0:
+        return {"error": "No active session. Please open a session in admin dashboard."}, 403
+
+    return _mark_student_present(
+        conn,
+        event_id=event_id,
+        session_id=session_id,
+        uid=uid,
+        device_id=device_id,
+        device_timestamp=device_timestamp,
+        now=_now_str(),
+    )
 
 
-def _excel_roster_preview_from_path(path: str) -> tuple[list[dict], str | None]:
-    try:
-        df = pd.read_excel(path)
-    except Exception as e:
-        return [], f"Unable to read Excel: {e}"
+def _scan_minute(timestamp: str, device_timestamp: str) -> str:
+    """Arrival-rate minute ("YYYY-MM-DD HH:MM") of a scan.
 
-    df.columns = [str(c).strip().lower() for c in df.columns]
-    required = {"uid", "name"}
-    if not required.issubset(set(df.columns)):
-        return [], "Excel must have uid and name columns"
+    The device's own scan time when it parses and is not after the server's, so an offline
+    queue replayed later lands in the minutes it was scanned in; otherwise the server time.
+    """
+    if re.match(r"[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}", device_timestamp) and device_timestamp <= timestamp:
+        return device_timestamp[:16]
+    return timestamp[:16]
 
-    rows: list[dict] = []
-    for _, row in df.iterrows():
-        uid = str(row.get("uid", "")).strip()
-        name = str(row.get("name", "")).strip()
-        branch = str(row.get("branch", "")).strip()
-        year = str(row.get("year", "")).strip()
-        if not uid or not name:
-            continue
-        rows.append({"uid": uid, "name": name, "branch": branch, "year": year})
-    return rows, None
 
+def _attendance_counter_names(source: str, device_id: str, timestamp: str, device_timestamp: str) -> list[str]:
+    """session_counters names one session_attendance row counts towards (see _COMPUTED_COUNTERS_SQL)."""
+    minute = _scan_minute(timestamp, device_timestamp)
+    names = ["present", f"source:{source}", f"minute:{minute}"]
+    if device_id:
+        names += [f"device:{device_id}", f"device_minute:{minute}|{device_id}"]
+    return names
+
+
+_ATTENDANCE_REPLACE_SQL = (
+    "DELETE FROM session_attendance WHERE session_id = ? AND uid = ?"
+    " RETURNING source, device_id, timestamp, device_timestamp"
+)
+_ATTENDANCE_INSERT_SQL = """
+    INSERT INTO session_attendance
+        (session_id, event_id, uid, timestamp, source, device_id, device_timestamp, seq)
+    VALUES
+        (?, ?, ?, ?, ?, ?, ?,
+         (SELECT COALESCE(MAX(seq), 0) + 1 FROM session_attendance WHERE event_id = ? AND session_id = ?))
+"""
+
+
+def _record_session_attendance(
+    conn: sqlite3.Connection,
+    *,
+    event_id: int,
+    session_id: int,
+    uid: str,
+    now: str,
+    source: str,
+    device_id: str = "",
+    device_timestamp: str = "",
+) -> None:
+    """Write the student's session_attendance row and its counter deltas (caller commits)."""
+    deltas = dict.fromkeys(_attendance_counter_names(source, device_id, now, device_timestamp), 1)
+    # A row can already exist when the roster was re-imported mid-session; replace it and
+    # take its old contribution off the counters.
+    old = conn.execute(_ATTENDANCE_REPLACE_SQL, (session_id, uid)).fetchone()
+    if old:
+        for name in _attendance_counter_names(
+            old["source"], old["device_id"], old["timestamp"], old["device_timestamp"]
+        ):
+            deltas[name] = deltas.get(name, 0) - 1
+    conn.execute(
+        _ATTENDANCE_INSERT_SQL,
+        (session_id, event_id, uid, now, source, device_id, device_timestamp, event_id, session_id),
+    )
+    _bump_session_counters(conn, event_id, session_id, deltas)
+
+
+_ADD_STUDENT_SQL = """
+    INSERT INTO students
+        (event_id, uid, name, branch, year, status, timestamp, source, device_id, device_timestamp,
+         roster_version)
+    VALUES
+        (?, ?, ?, ?, ?, 'Present', ?, 'Manual', '', '',
+         COALESCE((SELECT roster_version FROM event_versions WHERE event_id = ?), 0) + 1)
+    ON CONFLICT(event_id, uid) DO UPDATE SET
+        name = excluded.name,
+        branch = excluded.branch,
+        year = excluded.year,
+        status = excluded.status,
+        timestamp = excluded.timestamp,
+        source = excluded.source,
+        device_id = excluded.device_id,
+        device_timestamp = excluded.device_timestamp,
+        roster_version = excluded.roster_version
+     WHERE lower(students.status) != 'present'
+    RETURNING *
+"""
+
+
+def _add_student_present(
+    conn: sqlite3.Connection,
+    *,
+    event_id: int,
+    session_id: int,
+    uid: str,
+    name: str,
+    branch: str,
+    year: str,
+    now: str,
+) -> tuple[dict, int]:
+    """Insert (or overwrite) a manually added student as present (caller commits).
+
+    Same conditional-write rule as `_mark_student_present`: the upsert skips a student
+    that is already present, and an empty RETURNING means 409.
+
+    Returns: (response_body, http_status)
+    """
+    existed = conn.execute(_STUDENT_SQL, (event_id, uid)).fetchone()
+    # Unindex first (we need the old name); re-indexing afterwards restores the entry on 409 too.
+    _fts_unindex(conn, event_id, [uid])
+    updated = conn.execute(_ADD_STUDENT_SQL, (event_id, uid, name, branch, year, now, event_id)).fetchone()
+    _fts_index(conn, event_id, [uid])
+    if not updated:
+        row = conn.execute(_STUDENT_SQL, (event_id, uid)).fetchone()
+        return {"error": "Already marked", "student": dict(row) if row else {"event_id": event_id, "uid": uid}}, 409
 
-def _get_event(event_id: int) -> dict | None:
-    with _db() as conn:
-        row = conn.execute("SELECT * FROM events WHERE event_id = ?", (event_id,)).fetchone()
-        return dict(row) if row else None
+    # The row above was stamped with the version this bump produces.
+    _bump_event_versions(conn, event_id, roster=True)
 
+    if not existed:
+        _bump_session_counters(conn, event_id, 0, {"total": 1})
+    _record_session_attendance(conn, event_id=event_id, session_id=session_id, uid=uid, now=now, source="Manual")
+    return {"success": True, "timestamp": now, "student": dict(updated)}, 200
 
-def _require_event_id() -> int | None:
-    raw = request.args.get("event_id") or request.form.get("event_id")
-    if raw is None:
-        return None
-    try:
-        eid = int(raw)
-    except ValueError:
-        return None
-    return eid if eid > 0 else None
 
+_IDEMPOTENCY_KEY_SQL = "SELECT request_hash, status, body FROM idempotency_keys WHERE key = ?"
+_IDEMPOTENCY_STORE_SQL = (
+    "INSERT INTO idempotency_keys (key, request_hash, status, body, created_at) VALUES (?, ?, ?, ?, ?)"
+)
+_IDEMPOTENCY_PRUNE_SQL = "DELETE FROM idempotency_keys WHERE created_at < ?"
+_IDEMPOTENCY_CONFLICT = {"error": "Idempotency-Key was already used for a different uid or event_id"}
 
-def _get_sessions(event_id: int) -> list[dict]:
-    with _db() as conn:
-        rows = conn.execute(
-            "SELECT * FROM sessions WHERE event_id = ? ORDER BY session_id DESC", (event_id,)
-        ).fetchall()
-    return [dict(r) for r in rows]
+# key -> (request_hash, body, status)
+_idempotent_responses: OrderedDict[str, tuple[str, dict, int]] = OrderedDict()
+_idempotent_lock = threading.Lock()
+_idempotency_pruned = [0.0]
 
 
-def _get_active_session(event_id: int) -> dict | None:
-    with _db() as conn:
-        row = conn.execute(
-            "SELECT * FROM sessions WHERE event_id = ? AND is_active = 1 ORDER BY session_id DESC LIMIT 1",
-            (event_id,),
-        ).fetchone()
-    return dict(row) if row else None
+def _idempotency_key(route: str) -> str | None:
+    """The request's client key (Idempotency-Key header or JSON idempotency_key), scoped to `route`."""
+    raw = request.headers.get("Idempotency-Key") or (request.get_json(silent=True) or {}).get("idempotency_key")
+    key = str(raw or "").strip()[:200]
+    return f"{route}:{key}" if key else None
 
 
-def _ensure_default_session(event_id: int) -> int:
-    active = _get_active_session(event_id)
-    if active:
-        return int(active.get("session_id") or 0)
+def _request_hash(event_id: int, uid: str) -> str:
+    """What an idempotency key is bound to: a reused key with another hash gets 422, not a replay."""
+    return hashlib.sha256(json.dumps([event_id, uid]).encode()).hexdigest()
 
-    with _db() as conn:
-        row = conn.execute(
-            "SELECT session_id FROM sessions WHERE event_id = ? ORDER BY session_id DESC LIMIT 1",
-            (event_id,),
-        ).fetchone()
-        if row:
-            sid = int(row[0])
-            conn.execute("UPDATE sessions SET is_active = 1 WHERE session_id = ?", (sid,))
-            conn.commit()
-            return sid
 
-        conn.execute(
-            "INSERT INTO sessions (event_id, session_name, is_active, created_at) VALUES (?, ?, 1, ?)",
-            (event_id, "Session 1", _now_str()),
-        )
-        sid = int(conn.execute("SELECT last_insert_rowid() AS id").fetchone()[0])
-        conn.commit()
-        return sid
+def _remember_response(key: str, request_hash: str, body: dict, status: int) -> None:
+    with _idempotent_lock:
+        _idempotent_responses[key] = (request_hash, body, status)
+        _idempotent_responses.move_to_end(key)
+        while len(_idempotent_responses) > max(IDEMPOTENCY_CACHE_SIZE, 1):
+            _idempotent_responses.popitem(last=False)
 
 
-def _reset_event_roster_for_new_session(event_id: int) -> None:
-    """Reset per-student attendance fields so a new session can be taken for the same event.
+def _idempotent_replay(key: str | None, request_hash: str, *, check_db: bool = True) -> Response | None:
+    """The stored response for `key`, from memory (no DB work) or, with `check_db`, the table.
 
-    Note: This does not preserve historical sessions; it simply starts a fresh run.
+    A key stored for a different request gets a 422 instead.
     """
-    with _db() as conn:
-        conn.execute(
-            """
-            UPDATE students
-               SET status = 'Absent',
-                   timestamp = '',
-                   source = 'Imported',
-                   device_id = '',
-                   device_timestamp = ''
-             WHERE event_id = ?
-            """,
-            (event_id,),
-        )
-        conn.commit()
+    if not key:
+        return None
+    with _idempotent_lock:
+        hit = _idempotent_responses.get(key)
+        if hit is not None:
+            _idempotent_responses.move_to_end(key)
+    if hit is None and check_db:
+        row = _db().execute(_IDEMPOTENCY_KEY_SQL, (key,)).fetchone()
+        if row is not None:
+            hit = (row["request_hash"], json.loads(row["body"]), int(row["status"]))
+            _remember_response(key, *hit)
+    if hit is None:
+        return None
+    stored_hash, body, status = hit
+    if stored_hash and stored_hash != request_hash:
+        response = jsonify(_IDEMPOTENCY_CONFLICT)
+        response.status_code = 422
+        return response
+    return _replay_response(body, status)
 
 
-def _roster_counts(event_id: int) -> dict:
-    # Backwards-compatible wrapper (defaults to active session).
-    active = _get_active_session(event_id)
-    session_id = int(active.get("session_id") or 0) if active else 0
-    return _session_counts(event_id=event_id, session_id=session_id)
+def _replay_response(body: dict, status: int) -> Response:
+    response = jsonify(body)
+    response.status_code = status
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
 
 
-def _session_counts(*, event_id: int, session_id: int) -> dict:
-    session_id = int(session_id or 0)
-    if session_id <= 0:
-        session_id = _ensure_default_session(event_id)
+def _idempotent_write(
+    conn: sqlite3.Connection,
+    key: str | None,
+    request_hash: str,
+    fn: Callable[[sqlite3.Connection], tuple[dict, int]],
+) -> tuple[dict, int, bool]:
+    """Run `fn(conn)` at most once per key, storing its response in the same transaction (caller commits).
 
-    with _db() as conn:
-        total = int(conn.execute("SELECT COUNT(*) AS n FROM students WHERE event_id = ?", (event_id,)).fetchone()[0])
-        present = int(
-            conn.execute(
-                "SELECT COUNT(*) AS n FROM session_attendance WHERE event_id = ? AND session_id = ?",
-                (event_id, session_id),
-            ).fetchone()[0]
-        )
-    return {"total": total, "present": present, "remaining": max(total - present, 0), "total_scanned": present}
+    A key already stored for a different `request_hash` runs nothing and returns a 422,
+    which must not be remembered under the key.
+
+    Returns: (response_body, http_status, replayed)
+    """
+    if not key:
+        return (*fn(conn), False)
+    row = conn.execute(_IDEMPOTENCY_KEY_SQL, (key,)).fetchone()
+    if row is not None:
+        if row["request_hash"] and row["request_hash"] != request_hash:
+            return dict(_IDEMPOTENCY_CONFLICT), 422, False
+        return json.loads(row["body"]), int(row["status"]), True
+    body, status = fn(conn)
+    now = _now_str()
+    conn.execute(_IDEMPOTENCY_STORE_SQL, (key, request_hash, status, json.dumps(body), now))
+    if time.monotonic() - _idempotency_pruned[0] > 600:
+        _idempotency_pruned[0] = time.monotonic()
+        cutoff = (datetime.now() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+        conn.execute(_IDEMPOTENCY_PRUNE_SQL, (cutoff,))
+    return body, status, False
 
 
 def admin_required(fn):
@@ -420,14 +2985,18 @@ def home():
     return jsonify({"ok": True, "service": "attendance"})
 
 
+_OPEN_EVENTS_SQL = "SELECT * FROM events WHERE is_active = 1 ORDER BY event_id DESC"
+_EVENTS_SQL = "SELECT * FROM events ORDER BY event_id DESC"
+
+
 @app.get("/events")
 def list_events():
     active_only = request.args.get("active") == "1"
     with _db() as conn:
         if active_only:
-            rows = conn.execute("SELECT * FROM events WHERE is_active = 1 ORDER BY event_id DESC").fetchall()
+            rows = conn.execute(_OPEN_EVENTS_SQL).fetchall()
         else:
-            rows = conn.execute("SELECT * FROM events ORDER BY event_id DESC").fetchall()
+            rows = conn.execute(_EVENTS_SQL).fetchall()
     return jsonify([dict(r) for r in rows])
 
 
@@ -440,10 +3009,12 @@ def import_excel():
     if not event_id:
         return jsonify({"error": "event_id is required"}), 400
 
-    imported, err = _import_students_from_excel(event_id=event_id, file_storage=request.files.get("file"))
+    imported, err, timings = _import_students_from_excel(event_id=event_id, file_storage=request.files.get("file"))
+    if err and imported:
+        return jsonify({"error": err, "imported": imported, "partial": True}), 500
     if err:
         return jsonify({"error": err}), 400
-    return jsonify({"success": True, "event_id": event_id, "imported": imported})
+    return jsonify({"success": True, "event_id": event_id, "imported": imported, "timings_ms": timings})
 
 
 @app.post("/admin/api/import")
@@ -457,11 +3028,13 @@ def admin_api_import_excel():
     if not event:
         return jsonify({"error": "Invalid event_id"}), 404
 
-    imported, err = _import_students_from_excel(event_id=event_id, file_storage=request.files.get("file"))
+    imported, err, timings = _import_students_from_excel(event_id=event_id, file_storage=request.files.get("file"))
+    if err and imported:
+        return jsonify({"error": err, "imported": imported, "partial": True}), 500
     if err:
         return jsonify({"error": err}), 400
 
-    return jsonify({"success": True, "event_id": event_id, "imported": imported})
+    return jsonify({"success": True, "event_id": event_id, "imported": imported, "timings_ms": timings})
 
 
 @app.post("/admin/api/import/preview")
@@ -479,27 +3052,33 @@ def admin_api_import_preview():
     if not file:
         return jsonify({"error": "file is required"}), 400
 
-    if not ((file.filename or "").lower().endswith(".xlsx")):
-        return jsonify({"error": "Excel (.xlsx) file required"}), 400
+    file_type = _roster_file_type(file.filename or "")
+    if not file_type:
+        return jsonify({"error": "Excel (.xlsx) or CSV (.csv) file required"}), 400
 
     _cleanup_pending_imports(max_age_minutes=60)
     token = secrets.token_urlsafe(18)
-    path = _pending_import_path(token)
 
-    try:
-        file.save(path)
-    except Exception as e:
-        return jsonify({"error": f"Unable to save upload: {e}"}), 400
-
-    rows, err = _excel_roster_preview_from_path(path)
+    chunks, err = _open_roster(file.stream, file_type)
     if err:
-        try:
-            os.remove(path)
-        except Exception:
-            pass
         return jsonify({"error": err}), 400
 
-    return jsonify({"success": True, "event_id": event_id, "token": token, "rows": rows, "count": len(rows)})
+    try:
+        rows, count = _stage_roster_chunks(token=token, chunks=chunks)
+    except Exception as e:
+        _discard_pending_import(token)
+        return jsonify({"error": f"Unable to read {ROSTER_FILE_TYPES[file_type]}: {e}"}), 400
+
+    return jsonify(
+        {
+            "success": True,
+            "event_id": event_id,
+            "token": token,
+            "rows": rows,
+            "count": count,
+            "truncated": count > len(rows),
+        }
+    )
 
 
 @app.post("/admin/api/import/confirm")
@@ -517,49 +3096,15 @@ def admin_api_import_confirm():
     if not event:
         return jsonify({"error": "Invalid event_id"}), 404
 
-    path = _pending_import_path(token)
-    if not os.path.exists(path):
+    # The upload was parsed once at preview time; confirm is a bulk copy out of staging.
+    timings: dict = {}
+    inserted, err = _import_staged_roster(event_id=event_id, token=token, timings=timings)
+    if inserted is None:
         return jsonify({"error": "Import token expired. Please upload again."}), 400
+    if err:
+        return jsonify({"error": err, "imported": inserted, "partial": True}), 500
 
-    try:
-        with open(path, "rb") as f:
-            df = pd.read_excel(f)
-    except Exception as e:
-        return jsonify({"error": f"Unable to read saved Excel: {e}"}), 400
-
-    # Use the same normalization/import behavior.
-    df.columns = [str(c).strip().lower() for c in df.columns]
-    required = {"uid", "name"}
-    if not required.issubset(set(df.columns)):
-        return jsonify({"error": "Excel must have uid and name columns"}), 400
-
-    inserted = 0
-    with _db() as conn:
-        for _, row in df.iterrows():
-            uid = str(row.get("uid", "")).strip()
-            name = str(row.get("name", "")).strip()
-            branch = str(row.get("branch", "")).strip()
-            year = str(row.get("year", "")).strip()
-            if not uid or not name:
-                continue
-            conn.execute(
-                """
-                INSERT OR REPLACE INTO students
-                    (event_id, uid, name, branch, year, status, timestamp, source, device_id, device_timestamp)
-                VALUES
-                    (?, ?, ?, ?, ?, 'Absent', '', 'Imported', '', '')
-                """,
-                (event_id, uid, name, branch, year),
-            )
-            inserted += 1
-        conn.commit()
-
-    try:
-        os.remove(path)
-    except Exception:
-        pass
-
-    return jsonify({"success": True, "event_id": event_id, "imported": inserted})
+    return jsonify({"success": True, "event_id": event_id, "imported": inserted, "timings_ms": timings})
 
 
 @app.get("/export")
@@ -575,37 +3120,37 @@ def export_excel():
     except Exception:
         session_id = 0
 
-    rows = _attendance_export_rows_for_session(event_id=event_id, session_id=session_id, present_only=present_only)
-    df = pd.DataFrame(rows)
-    # Standardize export columns (same as live attendance table):
-    # UID, Name, Branch, Year, Status, Time, Source, Device
-    df = df.rename(
-        columns={
-            "uid": "UID",
-            "name": "Name",
-            "branch": "Branch",
-            "year": "Year",
-            "status": "Status",
-            "timestamp": "Time",
-            "source": "Source",
-            "device_id": "Device",
-        }
-    )
-    ordered = ["UID", "Name", "Branch", "Year", "Status", "Time", "Source", "Device"]
-    df = df[[c for c in ordered if c in df.columns]]
-    bio = io.BytesIO()
-    with pd.ExcelWriter(bio, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Attendance")
-    bio.seek(0)
+    export_format = (request.args.get("format") or "xlsx").strip().lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+
+    event = _get_event(event_id)
+    if event and event.get("archived_at"):
+        rows = _archived_export_rows(event_id=event_id, session_id=session_id, present_only=present_only)
+        if rows is None:
+            return jsonify({"error": "Archive file not found"}), 404
+    else:
+        rows = _attendance_export_cursor(event_id=event_id, session_id=session_id, present_only=present_only)
 
     suffix = "present" if present_only else "full"
     session_part = f"_session_{session_id}" if int(session_id or 0) > 0 else ""
-    filename = f"attendance_event_{event_id}{session_part}_{suffix}.xlsx"
-    return send_file(
-        bio,
-        as_attachment=True,
-        download_name=filename,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    filename = f"attendance_event_{event_id}{session_part}_{suffix}.{export_format}"
+
+    if export_format == "xlsx":
+        # Zip output can't be sent before it is finished; the write-only workbook and temp
+        # file keep memory flat, and send_file streams the result in blocks.
+        return send_file(
+            _export_xlsx_file(rows),
+            as_attachment=True,
+            download_name=filename,
+            mimetype=EXPORT_FORMATS["xlsx"],
+        )
+
+    chunks = _export_csv_chunks(rows) if export_format == "csv" else _export_ndjson_chunks(rows)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
@@ -625,65 +3170,65 @@ def mark_attendance():
     if not uid or event_id <= 0:
         return jsonify({"error": "uid and event_id are required"}), 400
 
-    active_session = _get_active_session(event_id)
-    if not active_session:
-        _ensure_default_session(event_id)
-        active_session = _get_active_session(event_id)
-    session_id = int(active_session.get("session_id") or 0) if active_session else 0
-    if session_id <= 0:
-        return jsonify({"error": "No active session. Please open a session in admin dashboard."}), 403
-
     _touch_device(device_id, event_id=event_id)
 
-    event = _get_event(event_id)
-    if not event:
-        return jsonify({"error": "Invalid event_id"}), 404
-    if not bool(event.get("is_active")):
-        return jsonify({"error": "Event is closed"}), 403
-
-    now = _now_str()
-    with _db() as conn:
-        row = conn.execute(
-            "SELECT * FROM students WHERE event_id = ? AND uid = ? LIMIT 1", (event_id, uid)
-        ).fetchone()
-        if not row:
+    # A retried request gets its original response back, even if it was a 200.
+    key = _idempotency_key("mark")
+    request_hash = _request_hash(event_id, uid)
+    replay = _idempotent_replay(key, request_hash)
+    if replay is not None:
+        return replay
+
+    # Reject closed events, unknown UIDs and repeat scans from the in-memory roster index
+    # without taking the write lock; anything else is decided by the database below.
+    index = _roster_index(event_id)
+    if index is not None:
+        if not index["event_active"]:
+            return jsonify({"error": "Event is closed"}), 403
+        if uid not in index["students"]:
             return jsonify({"error": "Invalid UID"}), 404
-
-        existing = dict(row)
-        if (existing.get("status") or "").lower() == "present":
-            return jsonify({"error": "Already marked", "student": existing}), 409
-
-        conn.execute(
-            """
-            UPDATE students
-               SET status = 'Present',
-                   timestamp = ?,
-                   source = 'Scanned',
-                   device_id = ?,
-                   device_timestamp = ?
-             WHERE event_id = ? AND uid = ?
-            """,
-            (now, device_id, device_timestamp, event_id, uid),
+        if uid in index["present"]:
+            # The original may have committed after the lookup above: it is stored by now.
+            replay = _idempotent_replay(key, request_hash)
+            if replay is not None:
+                return replay
+            student = dict(zip(STUDENT_COLUMNS, index["students"][uid]))
+            return jsonify({"error": "Already marked", "student": student}), 409
+
+    body, status, replayed = _run_write(
+        lambda conn: _idempotent_write(
+            conn,
+            key,
+            request_hash,
+            lambda conn: _mark_scan(conn, event_id=event_id, uid=uid, device_id=device_id, device_timestamp=device_timestamp),
         )
-
-        # Record per-session attendance (history).
-        conn.execute(
-            """
-            INSERT OR REPLACE INTO session_attendance
-                (session_id, event_id, uid, timestamp, source, device_id, device_timestamp)
-            VALUES
-                (?, ?, ?, ?, 'Scanned', ?, ?)
-            """,
-            (session_id, event_id, uid, now, device_id, device_timestamp),
-        )
-        conn.commit()
-
-        updated = conn.execute(
-            "SELECT * FROM students WHERE event_id = ? AND uid = ? LIMIT 1", (event_id, uid)
-        ).fetchone()
-        student = dict(updated) if updated else existing
-
-    return jsonify({"success": True, "timestamp": now, "student": student})
+    )
+    if key and status != 422:
+        _remember_response(key, request_hash, body, status)
+    if replayed:
+        return _replay_response(body, status)
+    if status == 200:
+        _stream_notify()
+    if status in (200, 409):
+        _roster_index_mark_present(event_id, body["student"], index=index)
+    return jsonify(body), status
+
+
+_SEARCH_SHORT_SQL = """
+    SELECT * FROM students
+     WHERE event_id = ?
+       AND (name LIKE ? OR uid LIKE ?)
+     ORDER BY name, uid
+     LIMIT ?
+"""
+_SEARCH_UID_PREFIX_SQL = "SELECT * FROM students WHERE event_id = ? AND uid >= ? AND uid < ? ORDER BY uid LIMIT ?"
+_SEARCH_NAME_PREFIX_SQL = """
+    SELECT * FROM students
+     WHERE event_id = ? AND name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE
+     ORDER BY name COLLATE NOCASE, uid
+     LIMIT ?
+"""
+_SEARCH_FTS_SQL = "SELECT * FROM students WHERE rowid IN (SELECT rowid FROM students_fts WHERE students_fts MATCH ? LIMIT ?)"
 
 
 @app.get("/search")
@@ -696,17 +3241,42 @@ def search_students():
     if not q:
         return jsonify([])
 
+    try:
+        limit = int(request.args.get("limit") or SEARCH_MAX_RESULTS)
+    except ValueError:
+        limit = SEARCH_MAX_RESULTS
+    limit = min(max(limit, 1), SEARCH_MAX_RESULTS)
+
     with _db() as conn:
-        rows = conn.execute(
-            """
-            SELECT * FROM students
-             WHERE event_id = ?
-               AND (name LIKE ? OR uid LIKE ?)
-             ORDER BY name, uid
-            """,
-            (event_id, f"%{q}%", f"%{q}%"),
-        ).fetchall()
-    return jsonify([dict(r) for r in rows])
+        if not _FTS_ENABLED or len(q) < 3:
+            # Trigrams need 3+ characters; short queries walk the name index and stop at the limit.
+            rows = conn.execute(_SEARCH_SHORT_SQL, (event_id, f"%{q}%", f"%{q}%", limit)).fetchall()
+            return jsonify([dict(r) for r in rows])
+
+        # Ranked in tiers, each read in its final order and cut at the limit by SQLite.
+        # 1. UID prefix hits, straight off the (event_id, uid) primary key.
+        found: dict[str, dict] = {}
+        for prefix in dict.fromkeys((q, q.upper())):
+            for r in conn.execute(_SEARCH_UID_PREFIX_SQL, (event_id, prefix, prefix + "\U0010ffff", limit)):
+                found.setdefault(r["uid"], dict(r))
+
+        # 2. Names starting with q (any case), a range on (event_id, name COLLATE NOCASE).
+        if len(found) < limit:
+            for r in conn.execute(_SEARCH_NAME_PREFIX_SQL, (event_id, q, q + "\U0010ffff", limit)):
+                found.setdefault(r["uid"], dict(r))
+
+        # 3. Another word of the name starting with q, then 4. any other substring, both from
+        # the trigram index (phrase == case-insensitive substring; names keep their spaces,
+        # so " q" matches at a word start). Within a tier hits come in roster order, which
+        # lets the index stop at the limit instead of ranking every match.
+        ev = f"ev : {_fts_phrase(f'#{event_id}#')}"
+        for match in (f"{ev} AND name : {_fts_phrase(' ' + q)}", f"{ev} AND {{uid name}} : {_fts_phrase(q)}"):
+            if len(found) >= limit:
+                break
+            for r in conn.execute(_SEARCH_FTS_SQL, (match, limit)):
+                found.setdefault(r["uid"], dict(r))
+
+    return jsonify(list(found.values())[:limit])
 
 
 @app.post("/add")
@@ -724,6 +3294,20 @@ def add_student():
     if not uid or not name or event_id <= 0:
         return jsonify({"error": "event_id, uid and name are required"}), 400
 
+    key = _idempotency_key("add")
+    request_hash = _request_hash(event_id, uid)
+    replay = _idempotent_replay(key, request_hash)
+    if replay is not None:
+        return replay
+
+    index = _roster_index(event_id)
+    if index is not None and index["session_id"] > 0 and uid in index["present"]:
+        replay = _idempotent_replay(key, request_hash)
+        if replay is not None:
+            return replay
+        student = dict(zip(STUDENT_COLUMNS, index["students"][uid]))
+        return jsonify({"error": "Already marked", "student": student}), 409
+
     active_session = _get_active_session(event_id)
     if not active_session:
         _ensure_default_session(event_id)
@@ -732,41 +3316,175 @@ def add_student():
     if session_id <= 0:
         return jsonify({"error": "No active session. Please open a session in admin dashboard."}), 403
 
+    body, status, replayed = _run_write(
+        lambda conn: _idempotent_write(
+            conn,
+            key,
+            request_hash,
+            lambda conn: _add_student_present(
+                conn,
+                event_id=event_id,
+                session_id=session_id,
+                uid=uid,
+                name=name,
+                branch=branch,
+                year=year,
+                now=_now_str(),
+            ),
+        )
+    )
+    if key and status != 422:
+        _remember_response(key, request_hash, body, status)
+    if replayed:
+        return _replay_response(body, status)
+    if status == 200:
+        _stream_notify()
+    if status in (200, 409):
+        _roster_index_mark_present(event_id, body["student"], index=index, session_id=session_id, added=True)
+    return jsonify(body), status
+
+
+@app.post("/mark/batch")
+def mark_attendance_batch():
+    """Apply a drained Android offline queue in one transaction.
+
+    JSON: {device_id, items: [{action, uid, event_id, device_timestamp | name, branch, year}, ...]}
+    where action is MARK_PRESENT or ADD_STUDENT (INSERT_STUDENT). Each item gets the same
+    status/body that /mark or /add would have returned for it, in request order.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    device_id = str(data.get("device_id", "")).strip()
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items are required"}), 400
+
+    max_items = int(os.environ.get("MARK_BATCH_MAX", "5000") or "5000")
+    if len(items) > max_items:
+        return jsonify({"error": f"Too many items (max {max_items})"}), 413
+
+    def _event_id_of(item) -> int:
+        try:
+            return int(item.get("event_id") or data.get("event_id") or 0)
+        except Exception:
+            return 0
+
+    # Resolve every referenced event/session once, before the write transaction starts.
+    contexts: dict[int, tuple[dict | None, int]] = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        event_id = _event_id_of(item)
+        if event_id <= 0 or event_id in contexts:
+            continue
+        event = _get_event(event_id)
+        session_id = _ensure_default_session(event_id) if event else 0
+        contexts[event_id] = (event, session_id)
+
+    last_event_id = next(iter(contexts), None)
+
     now = _now_str()
-    with _db() as conn:
-        row = conn.execute(
-            "SELECT * FROM students WHERE event_id = ? AND uid = ? LIMIT 1", (event_id, uid)
-        ).fetchone()
-        if row and (row["status"] or "").lower() == "present":
-            return jsonify({"error": "Already marked", "student": dict(row)}), 409
+    # The heartbeat is buffered here (it reads the request) and written by the job below.
+    _touch_device(device_id, event_id=last_event_id)
+
+    def apply(conn: sqlite3.Connection, indexes: list[int]) -> list[dict]:
+        results: list[dict] = []
+        _flush_device_heartbeats(conn)
+        for index in indexes:
+            item = items[index]
+            if not isinstance(item, dict):
+                results.append({"index": index, "status": 400, "error": "item must be an object"})
+                continue
 
-        conn.execute(
-            """
-            INSERT OR REPLACE INTO students
-                (event_id, uid, name, branch, year, status, timestamp, source, device_id, device_timestamp)
-            VALUES
-                (?, ?, ?, ?, ?, 'Present', ?, 'Manual', '', '')
-            """,
-            (event_id, uid, name, branch, year, now),
-        )
+            action = str(item.get("action", "")).strip().upper()
+            uid = str(item.get("uid", "")).strip()
+            event_id = _event_id_of(item)
+            event, session_id = contexts.get(event_id, (None, 0))
+
+            if action == "MARK_PRESENT":
+                if not uid or event_id <= 0:
+                    body, status = {"error": "uid and event_id are required"}, 400
+                elif not event:
+                    body, status = {"error": "Invalid event_id"}, 404
+                elif not bool(event.get("is_active")):
+                    body, status = {"error": "Event is closed"}, 403
+                elif session_id <= 0:
+                    body, status = {"error": "No active session. Please open a session in admin dashboard."}, 403
+                else:
+                    body, status = _mark_student_present(
+                        conn,
+                        event_id=event_id,
+                        session_id=session_id,
+                        uid=uid,
+                        device_id=str(item.get("device_id") or device_id).strip(),
+                        device_timestamp=str(item.get("device_timestamp", "")).strip(),
+                        now=now,
+                    )
+            elif action in ("ADD_STUDENT", "INSERT_STUDENT"):
+                name = str(item.get("name", "")).strip()
+                if not uid or not name or event_id <= 0:
+                    body, status = {"error": "event_id, uid and name are required"}, 400
+                elif not event:
+                    body, status = {"error": "Invalid event_id"}, 404
+                elif session_id <= 0:
+                    body, status = {"error": "No active session. Please open a session in admin dashboard."}, 403
+                else:
+                    body, status = _add_student_present(
+                        conn,
+                        event_id=event_id,
+                        session_id=session_id,
+                        uid=uid,
+                        name=name,
+                        branch=str(item.get("branch", "")).strip(),
+                        year=str(item.get("year", "")).strip(),
+                        now=now,
+                    )
+            else:
+                body, status = {"error": f"Unknown action: {action or '-'}"}, 400
+
+            results.append({"index": index, "status": status, **body})
+        return results
+
+    # With EVENT_SHARDS each event's items commit in that event's shard (one transaction
+    # per event); items that touch no database all go with the first group.
+    groups: dict[int | None, list[int]] = {}
+    for index, item in enumerate(items):
+        event_id = _event_id_of(item) if isinstance(item, dict) else 0
+        groups.setdefault(event_id if EVENT_SHARDS and contexts.get(event_id, (None, 0))[0] else None, []).append(index)
+    with _roster_indexes_lock:
+        roster_indexes = {event_id: _roster_indexes.get(event_id) for event_id in contexts}
+    results: list[dict] = [{}] * len(items)
+    for event_id, indexes in groups.items():
+        with _event_scope(event_id):
+            for index, result in zip(indexes, _run_write(lambda conn, indexes=indexes: apply(conn, indexes))):
+                results[index] = result
+
+    if any(result["status"] == 200 for result in results):
+        _stream_notify()
+
+    for item, result in zip(items, results):
+        action = str(item.get("action", "")).strip().upper() if isinstance(item, dict) else ""
+        if result["status"] in (200, 409) and result.get("student") and action in ("MARK_PRESENT", "ADD_STUDENT", "INSERT_STUDENT"):
+            # Sessions were resolved before the write, so the index may already be for a newer one.
+            event_id = _event_id_of(item)
+            _roster_index_mark_present(
+                event_id,
+                result["student"],
+                index=roster_indexes.get(event_id),
+                session_id=contexts[event_id][1],
+                added=action != "MARK_PRESENT",
+            )
 
-        conn.execute(
-            """
-            INSERT OR REPLACE INTO session_attendance
-                (session_id, event_id, uid, timestamp, source, device_id, device_timestamp)
-            VALUES
-                (?, ?, ?, ?, 'Manual', '', '')
-            """,
-            (session_id, event_id, uid, now),
-        )
-        conn.commit()
+    return jsonify({"success": True, "timestamp": now, "results": results})
 
-        updated = conn.execute(
-            "SELECT * FROM students WHERE event_id = ? AND uid = ? LIMIT 1", (event_id, uid)
-        ).fetchone()
-        student = dict(updated) if updated else {"event_id": event_id, "uid": uid, "name": name}
 
-    return jsonify({"success": True, "timestamp": now, "student": student})
+# Global /stats sums the per-event counters: every roster, and each event's open session.
+_STATS_TOTAL_SQL = "SELECT COALESCE(SUM(value), 0) FROM session_counters WHERE session_id = 0 AND name = 'total'"
+_STATS_PRESENT_SQL = """
+    SELECT COALESCE(SUM((SELECT c.value FROM session_counters c
+                          WHERE c.event_id = ss.event_id AND c.session_id = ss.session_id AND c.name = 'present')), 0)
+      FROM sessions ss
+     WHERE ss.is_active = 1
+"""
 
 
 @app.get("/stats")
@@ -783,14 +3501,118 @@ def stats():
     if event_id:
         return jsonify(_roster_counts(event_id))
 
-    with _db() as conn:
-        total = conn.execute("SELECT COUNT(*) AS n FROM students").fetchone()[0]
-        present = conn.execute("SELECT COUNT(*) AS n FROM students WHERE status = 'Present'").fetchone()[0]
-    total = int(total)
-    present = int(present)
+    total = present = 0
+    for scope in _event_scopes():
+        with _event_scope(scope), _db() as conn:
+            total += int(conn.execute(_STATS_TOTAL_SQL).fetchone()[0])
+            present += int(conn.execute(_STATS_PRESENT_SQL).fetchone()[0])
     return jsonify({"total": total, "present": present, "remaining": max(total - present, 0)})
 
 
+def _metric_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_metric_label_value(value)}"' for key, value in labels) + "}"
+
+
+_OPEN_EVENT_SESSIONS_SQL = """
+    SELECT e.event_id,
+           (SELECT ss.session_id FROM sessions ss
+             WHERE ss.event_id = e.event_id AND ss.is_active = 1
+             ORDER BY ss.session_id DESC LIMIT 1) AS session_id
+      FROM events e
+     WHERE e.is_active = 1
+"""
+_RECENT_SCANS_SQL = "SELECT COUNT(*) FROM session_attendance WHERE event_id = ? AND session_id = ? AND timestamp >= ?"
+# Range on last_seen; left alone the planner walks idx_devices_last_event (every device) to skip the sort.
+_ONLINE_DEVICES_SQL = """
+    SELECT last_event_id, COUNT(*) FROM devices INDEXED BY idx_devices_last_seen
+     WHERE last_seen >= ? GROUP BY last_event_id
+"""
+
+
+def _domain_gauges() -> list[tuple[str, str, str, list[tuple[tuple, float]]]]:
+    """Live gauges read from the database at scrape time (already global across workers)."""
+    online_window_seconds = int(os.environ.get("DEVICE_ONLINE_SECONDS", "120") or "120")
+    now = datetime.now()
+    minute_ago = (now - timedelta(seconds=60)).strftime("%Y-%m-%d %H:%M:%S")
+    online_cutoff = (now - timedelta(seconds=online_window_seconds)).strftime("%Y-%m-%d %H:%M:%S")
+    scans, present, total, devices = [], [], [], []
+    with _event_scope(None), _db() as conn:
+        open_sessions = conn.execute(_OPEN_EVENT_SESSIONS_SQL).fetchall()
+        for row in open_sessions:
+            event_id, session_id = int(row["event_id"]), int(row["session_id"] or 0)
+            labels = (("event_id", str(event_id)),)
+            with _event_scope(event_id), _db() as event_conn:
+                recent = event_conn.execute(_RECENT_SCANS_SQL, (event_id, session_id, minute_ago)).fetchone()[0]
+                counts = _read_session_counts(event_conn, event_id=event_id, session_id=session_id)
+            scans.append((labels, int(recent) / 60.0))
+            present.append((labels, counts["present"]))
+            total.append((labels, counts["total"]))
+        for row in conn.execute(_ONLINE_DEVICES_SQL, (online_cutoff,)):
+            devices.append(((("event_id", str(row[0] or 0)),), int(row[1])))
+    return [
+        ("attendance_scans_per_second", "gauge", "Marks per second over the last minute (open events).", scans),
+        ("attendance_present", "gauge", "Students present in the open session.", present),
+        ("attendance_roster_total", "gauge", "Students on the event roster.", total),
+        ("attendance_active_devices", "gauge", "Devices seen within DEVICE_ONLINE_SECONDS, by last event.", devices),
+    ]
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition: request/DB metrics summed over all workers plus live gauges."""
+    _metrics_flush(force=True)
+    counters, histograms = _metrics_collect()
+
+    lines: list[str] = []
+    families: dict[str, list[str]] = {}
+    for (name, labels), value in sorted(counters.items()):
+        families.setdefault(name, []).append(f"{name}{_metric_labels(labels)} {value:g}")
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        series = families.setdefault(name, [])
+        cumulative = 0
+        for bound, n in zip((*_LATENCY_BUCKETS, "+Inf"), buckets):
+            cumulative += n
+            series.append(f"{name}_bucket{_metric_labels((*labels, ('le', str(bound))))} {cumulative}")
+        series.append(f"{name}_sum{_metric_labels(labels)} {total:.6f}")
+        series.append(f"{name}_count{_metric_labels(labels)} {count}")
+    for name in sorted(families):
+        kind, help_text = _METRIC_HELP.get(name, ("untyped", name))
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", *families[name]]
+
+    for name, kind, help_text, samples in _domain_gauges():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [f"{name}{_metric_labels(labels)} {value:g}" for labels, value in samples]
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/admin/api/profiler")
+@admin_required
+def admin_api_profiler():
+    return jsonify({**_profiler_settings(), "dir": PROFILE_DIR})
+
+
+@app.post("/admin/api/profiler")
+@admin_required
+def admin_api_profiler_update():
+    """Set {routes, every, mode} for every worker; an empty routes list turns profiling off."""
+    data = request.get_json(silent=True) or {}
+    if data.get("mode") and str(data["mode"]).strip().lower() not in PROFILE_MODES:
+        return jsonify({"error": f"mode must be one of: {', '.join(PROFILE_MODES)}"}), 400
+    try:
+        settings = _save_profiler_settings(data)
+    except OSError:
+        app.logger.exception("Could not save profiler settings")
+        return jsonify({"error": "could not save profiler settings"}), 500
+    return jsonify({**settings, "dir": PROFILE_DIR})
+
+
 @app.get("/admin/login")
 def admin_login():
     return render_template(
@@ -861,6 +3683,10 @@ def admin_dashboard():
     )
 
 
+# last_seen is always written by _now_str(), so the online check is a string comparison.
+_DASHBOARD_DEVICES_SQL = "SELECT device_id, last_seen, last_ip, last_seen >= ? AS online FROM devices WHERE last_event_id = ?"
+
+
 @app.get("/admin/api/dashboard")
 @admin_required
 def admin_api_dashboard():
@@ -881,65 +3707,32 @@ def admin_api_dashboard():
     summary = _session_counts(event_id=event_id, session_id=session_id)
 
     online_window_seconds = int(os.environ.get("DEVICE_ONLINE_SECONDS", "120") or "120")
-    online_cutoff = datetime.now() - timedelta(seconds=online_window_seconds)
+    online_cutoff = (datetime.now() - timedelta(seconds=online_window_seconds)).strftime("%Y-%m-%d %H:%M:%S")
 
     with _db() as conn:
-        present_by_device = {
-            r["device_id"]: int(r["present_count"])
-            for r in conn.execute(
-                """
-                SELECT device_id, COUNT(*) AS present_count
-                  FROM session_attendance
-                 WHERE event_id = ? AND session_id = ? AND device_id != ''
-                 GROUP BY device_id
-                """,
-                (event_id, session_id),
-            ).fetchall()
-        }
+        present_by_device = _session_counter_values(conn, event_id=event_id, session_id=session_id, prefix="device:")
 
         device_info = {
             r["device_id"]: dict(r)
-            for r in conn.execute(
-                """
-                SELECT device_id, last_seen, last_ip
-                  FROM devices
-                 WHERE last_event_id = ?
-                """,
-                (event_id,),
-            ).fetchall()
+            for r in conn.execute(_DASHBOARD_DEVICES_SQL, (online_cutoff, event_id)).fetchall()
         }
 
-        # Live attendance for the selected session.
-        attendance_rows = conn.execute(
-            """
-            SELECT s.uid, s.name, s.branch, s.year,
-                   'Present' AS status,
-                   sa.timestamp AS timestamp,
-                   sa.source AS source,
-                   sa.device_id AS device_id
-              FROM session_attendance sa
-              JOIN students s
-                ON s.event_id = sa.event_id AND s.uid = sa.uid
-             WHERE sa.event_id = ? AND sa.session_id = ?
-             ORDER BY sa.timestamp DESC, s.name, s.uid
-            """,
-            (event_id, session_id),
-        ).fetchall()
+        # Live attendance for the selected session (only rows after ?since= when given).
+        attendance, cursor, delta = _session_attendance_feed(
+            conn, event_id=event_id, session_id=session_id, since=_parse_since()
+        )
 
     device_ids = set(present_by_device.keys()) | set(device_info.keys())
     device_stats: list[dict] = []
     for device_id in device_ids:
         info = device_info.get(device_id, {})
-        last_seen = str(info.get("last_seen", "") or "")
-        last_seen_dt = _parse_dt(last_seen)
-        online = bool(last_seen_dt and last_seen_dt >= online_cutoff)
         device_stats.append(
             {
                 "device_id": device_id,
                 "present_count": int(present_by_device.get(device_id, 0)),
-                "last_seen": last_seen,
+                "last_seen": str(info.get("last_seen", "") or ""),
                 "last_ip": str(info.get("last_ip", "") or ""),
-                "online": online,
+                "online": bool(info.get("online")),
             }
         )
     device_stats.sort(key=lambda d: (not bool(d.get("online")), -(int(d.get("present_count") or 0)), str(d.get("device_id") or "")))
@@ -950,11 +3743,42 @@ def admin_api_dashboard():
             "summary": summary,
             "device_stats": device_stats,
             "session_id": session_id,
-            "attendance": [dict(r) for r in attendance_rows],
+            "attendance": attendance,
+            "cursor": cursor,
+            "delta": delta,
         }
     )
 
 
+@app.get("/admin/api/analytics")
+@admin_required
+def admin_api_analytics():
+    event_id = _require_event_id()
+    if not event_id:
+        return jsonify({"error": "event_id is required"}), 400
+
+    raw_session_id = request.args.get("session_id")
+    try:
+        session_id = int(raw_session_id) if raw_session_id is not None and raw_session_id != "" else 0
+    except Exception:
+        session_id = 0
+
+    if session_id <= 0:
+        active = _get_active_session(event_id)
+        session_id = int(active.get("session_id") or 0) if active else _ensure_default_session(event_id)
+
+    try:
+        minutes = int(request.args.get("minutes") or 60)
+    except Exception:
+        minutes = 60
+    minutes = max(1, min(minutes, 1440))
+
+    with _db() as conn:
+        rates = _arrival_rates(conn, event_id=event_id, session_id=session_id, minutes=minutes)
+
+    return jsonify({"server_time": _now_str(), "event_id": event_id, "session_id": session_id, **rates})
+
+
 @app.post("/admin/events/create")
 @admin_required
 def admin_create_event():
@@ -998,8 +3822,11 @@ def admin_api_sessions():
 @app.post("/admin/events/<int:event_id>/sessions/create")
 @admin_required
 def admin_create_session(event_id: int):
-    if not _get_event(event_id):
+    event = _get_event(event_id)
+    if not event:
         return redirect(url_for("admin_dashboard"))
+    if event.get("archived_at"):
+        return (jsonify({"error": "Event is archived"}), 409)
 
     name = (request.form.get("session_name") or "").strip() or f"Session {_now_str()}"
 
@@ -1012,6 +3839,7 @@ def admin_create_session(event_id: int):
             "INSERT INTO sessions (event_id, session_name, is_active, created_at) VALUES (?, ?, 1, ?)",
             (event_id, name, _now_str()),
         )
+        _bump_event_versions(conn, event_id, session=True)
         conn.commit()
 
     return redirect(url_for("admin_dashboard", event_id=event_id))
@@ -1037,6 +3865,7 @@ def admin_open_session(session_id: int):
 
         conn.execute("UPDATE sessions SET is_active = 0 WHERE event_id = ?", (event_id,))
         conn.execute("UPDATE sessions SET is_active = 1 WHERE session_id = ?", (session_id,))
+        _bump_event_versions(conn, event_id, session=True)
         conn.commit()
 
     return ("", 204)
@@ -1046,7 +3875,10 @@ def admin_open_session(session_id: int):
 @admin_required
 def admin_close_session(session_id: int):
     with _db() as conn:
+        row = conn.execute("SELECT event_id FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
         conn.execute("UPDATE sessions SET is_active = 0 WHERE session_id = ?", (session_id,))
+        if row:
+            _bump_event_versions(conn, int(row[0]), session=True)
         conn.commit()
     return ("", 204)
 
@@ -1056,6 +3888,7 @@ def admin_close_session(session_id: int):
 def admin_close_event(event_id: int):
     with _db() as conn:
         conn.execute("UPDATE events SET is_active = 0 WHERE event_id = ?", (event_id,))
+        _bump_event_versions(conn, event_id, session=True)
         conn.commit()
     return ("", 204)
 
@@ -1063,13 +3896,24 @@ def admin_close_event(event_id: int):
 @app.post("/admin/events/<int:event_id>/open")
 @admin_required
 def admin_open_event(event_id: int):
+    event = _get_event(event_id)
+    if event and event.get("archived_at"):
+        return (jsonify({"error": "Event is archived"}), 409)
     with _db() as conn:
         conn.execute("UPDATE events SET is_active = 1 WHERE event_id = ?", (event_id,))
+        _bump_event_versions(conn, event_id, session=True)
         conn.commit()
     _ensure_default_session(event_id)
     return ("", 204)
 
 
+@app.post("/admin/events/<int:event_id>/archive")
+@admin_required
+def admin_archive_event(event_id: int):
+    body, status = _archive_event(event_id)
+    return jsonify(body), status
+
+
 @app.get("/event/<int:event_id>/live")
 def event_live(event_id: int):
     event = _get_event(event_id)
@@ -1087,34 +3931,51 @@ def api_event_live(event_id: int):
     session_id = int(active.get("session_id") or 0) if active else _ensure_default_session(event_id)
     summary = _session_counts(event_id=event_id, session_id=session_id)
     with _db() as conn:
-        recent = conn.execute(
-            """
-            SELECT s.uid, s.name, s.branch, s.year,
-                   'Present' AS status,
-                   sa.timestamp AS timestamp,
-                   sa.source AS source,
-                   sa.device_id AS device_id
-              FROM session_attendance sa
-              JOIN students s
-                ON s.event_id = sa.event_id AND s.uid = sa.uid
-             WHERE sa.event_id = ? AND sa.session_id = ?
-             ORDER BY sa.timestamp DESC
-             LIMIT 50
-            """,
-            (event_id, session_id),
-        ).fetchall()
+        recent, cursor, delta = _session_attendance_feed(
+            conn, event_id=event_id, session_id=session_id, since=_parse_since(), limit=STREAM_ROWS
+        )
 
     return jsonify(
         {
             "server_time": _now_str(),
             "event": event,
             "session_id": session_id,
-            "attendance": [dict(r) for r in recent],
+            "attendance": recent,
+            "cursor": cursor,
+            "delta": delta,
             **summary,
         }
     )
 
 
+@app.get("/api/event/<int:event_id>/stream")
+def api_event_stream(event_id: int):
+    """Server-Sent Events version of /api/event/<id>/live.
+
+    The first `live` event is a snapshot; later ones carry only rows marked since the
+    previous event (delta=true) plus the updated counts. Reconnects resume from
+    Last-Event-ID. With STREAM_MAX_PER_WORKER streams already open in this worker the
+    answer is 503 + Retry-After, which ends the EventSource; pages then poll /live.
+    """
+    if not _get_event(event_id):
+        return jsonify({"error": "Not found"}), 404
+    if _stream_slots is None or not _stream_slots.acquire(blocking=False):
+        return (
+            jsonify({"error": "Too many live streams on this worker; poll /api/event/<id>/live instead"}),
+            503,
+            {"Retry-After": str(STREAM_BUSY_RETRY_SECONDS)},
+        )
+    session_id, since = _parse_stream_id(request.headers.get("Last-Event-ID"))
+    response = Response(
+        stream_with_context(_live_stream(event_id, session_id=session_id, since=since)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+    # Runs when the server closes the response, even if the stream never started.
+    response.call_on_close(_stream_slots.release)
+    return response
+
+
 @app.get("/api/event/<int:event_id>/session")
 def api_event_session(event_id: int):
     event = _get_event(event_id)
@@ -1138,23 +3999,121 @@ def api_event_session(event_id: int):
     )
 
 
+_ROSTER_SQL = "SELECT uid, name, branch, year FROM students WHERE event_id = ? ORDER BY name, uid"
+_ROSTER_DELTA_SQL = (
+    "SELECT uid, name, branch, year FROM students WHERE event_id = ? AND roster_version > ? ORDER BY name, uid"
+)
+
+
 @app.get("/api/event/<int:event_id>/roster")
 def api_event_roster(event_id: int):
     """Public roster endpoint for Android clients.
 
-    Returns the student list imported for the event (UID/Name/Branch/Year).
+    Returns the student list imported for the event (UID/Name/Branch/Year) as a JSON
+    array. The roster version travels in `ETag` / `X-Roster-Version`; a matching
+    `If-None-Match` gets 304. With `?since_version=N` the body is instead
+    {version, delta, upserted: [...], removed: [...]}, where `upserted` holds only rows
+    written after version N (delta=false means N was unknown and it is the full roster).
     """
     event = _get_event(event_id)
     if not event:
         return jsonify({"error": "Not found"}), 404
 
-    with _db() as conn:
-        rows = conn.execute(
-            "SELECT uid, name, branch, year FROM students WHERE event_id = ? ORDER BY name, uid",
-            (event_id,),
-        ).fetchall()
+    since_raw = request.args.get("since_version")
+    try:
+        since = int(since_raw) if since_raw not in (None, "") else None
+    except ValueError:
+        return jsonify({"error": "since_version must be an integer"}), 400
 
-    return jsonify([dict(r) for r in rows])
+    with _db() as conn:
+        row = conn.execute(_EVENT_VERSIONS_SQL, (event_id,)).fetchone()
+        version = int(row["roster_version"]) if row else 0
+        etag = f'"roster-{event_id}-{version}"'
+        headers = {"ETag": etag, "X-Roster-Version": str(version), "Cache-Control": "no-cache"}
+        if etag in [t.strip() for t in request.headers.get("If-None-Match", "").split(",")]:
+            return Response(status=304, headers=headers)
+
+        delta = since is not None and 0 < since <= version
+        if delta:
+            rows = conn.execute(_ROSTER_DELTA_SQL, (event_id, since)).fetchall()
+        else:
+            rows = conn.execute(_ROSTER_SQL, (event_id,)).fetchall()
+
+    students = [dict(r) for r in rows]
+    if since is None:
+        resp = jsonify(students)
+    else:
+        # Students are only ever upserted (imports replace, /add inserts), so nothing is removed yet.
+        resp = jsonify({"version": version, "delta": delta, "upserted": students, "removed": []})
+    resp.headers.update(headers)
+    return resp
+
+
+# Queries on request paths, checked by `flask --app app check-query-plans` and
+# tests/test_query_plans.py: none of them may fall back to a full table scan. Every
+# module-level *_SQL statement a request runs belongs here.
+HOT_QUERIES = (
+    ("event", _EVENT_SQL),
+    ("open events", _OPEN_EVENTS_SQL),
+    ("events list", _EVENTS_SQL),
+    ("event archived", _EVENT_ARCHIVED_SQL),
+    ("event sessions", _EVENT_SESSIONS_SQL),
+    ("active session", _ACTIVE_SESSION_SQL),
+    ("newest session", _NEWEST_SESSION_SQL),
+    ("scan event", _SCAN_EVENT_SQL),
+    ("mark present", _MARK_PRESENT_SQL),
+    ("student by uid", _STUDENT_SQL),
+    ("add student", _ADD_STUDENT_SQL),
+    ("session row replace", _ATTENDANCE_REPLACE_SQL),
+    ("session row insert", _ATTENDANCE_INSERT_SQL),
+    ("counter bump", _COUNTER_BUMP_SQL),
+    ("session counts", _SESSION_COUNTS_SQL),
+    ("counter range", _COUNTER_RANGE_SQL),
+    ("event versions", _EVENT_VERSIONS_SQL),
+    ("event versions bump", _EVENT_VERSIONS_BUMP_SQL),
+    ("roster index event", _ROSTER_INDEX_EVENT_SQL),
+    ("roster index", _ROSTER_INDEX_SQL),
+    ("roster index delta", _ROSTER_INDEX_DELTA_SQL),
+    ("roster", _ROSTER_SQL),
+    ("roster delta", _ROSTER_DELTA_SQL),
+    ("feed cursor", _FEED_CURSOR_SQL),
+    ("attendance feed", _FEED_SQL),
+    ("present export", _PRESENT_EXPORT_SQL),
+    ("full export", _FULL_EXPORT_SQL),
+    ("idempotency key", _IDEMPOTENCY_KEY_SQL),
+    ("idempotency store", _IDEMPOTENCY_STORE_SQL),
+    ("idempotency prune", _IDEMPOTENCY_PRUNE_SQL),
+    ("device heartbeat", _DEVICE_HEARTBEAT_SQL),
+    ("dashboard devices", _DASHBOARD_DEVICES_SQL),
+    ("search short", _SEARCH_SHORT_SQL),
+    ("search uid prefix", _SEARCH_UID_PREFIX_SQL),
+    ("search name prefix", _SEARCH_NAME_PREFIX_SQL),
+    ("search fts", _SEARCH_FTS_SQL),
+    ("global stats total", _STATS_TOTAL_SQL),
+    ("global stats present", _STATS_PRESENT_SQL),
+    ("gauge open sessions", _OPEN_EVENT_SESSIONS_SQL),
+    ("gauge recent scans", _RECENT_SCANS_SQL),
+    ("gauge online devices", _ONLINE_DEVICES_SQL),
+    ("staged rows", _STAGED_UIDS_SQL),
+    ("staged copy", _STAGED_COPY_SQL),
+    ("new uids count", _NEW_UIDS_COUNT_SQL),
+    ("fts unindex", _FTS_UNINDEX_SQL),
+    ("fts index", _FTS_INDEX_SQL),
+    ("stale preview rows", _STALE_IMPORT_ROWS_SQL),
+    ("stale previews", _STALE_IMPORTS_SQL),
+    ("archive fingerprint", _ARCHIVE_FINGERPRINT_SQL),
+)
+
+# Listings that return every row of a small catalog table: the named table scan is their
+# plan, and any other scan step in them is still reported.
+FULL_SCAN_QUERIES = {
+    "events list": "SCAN events",
+}
+
+# Schema setup runs once every helper it calls is defined.
+init_db()
+# Drop the import-time connection so a forking server never hands it to a worker.
+_close_db()
 
 
 if __name__ == "__main__":
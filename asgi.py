@@ -0,0 +1,168 @@
+"""Opt-in ASGI entry point: `uvicorn asgi:app --workers 2` (render.yaml still deploys wsgi:app).
+
+Live streams (/api/event/<id>/stream) are served on the event loop, so an open viewer costs
+a coroutine instead of a worker thread. Every other route, including /mark, /stats, /live and
+the roster, goes through a2wsgi's WSGIMiddleware: the unchanged Flask view runs on a bounded
+pool of ASGI_THREADS threads (sqlite3 blocks), with the same concurrency as gunicorn's
+--threads. Each request stays on one thread, so it keeps using that thread's pooled connection.
+"""
+
+import asyncio
+import os
+import re
+import time
+
+from a2wsgi import WSGIMiddleware
+
+from app import (
+    STREAM_KEEPALIVE_SECONDS,
+    STREAM_MAX_SECONDS,
+    _db,
+    _event_scope,
+    _get_event,
+    _live_snapshot,
+    _metric_inc,
+    _metric_observe,
+    _parse_stream_id,
+    _sse,
+    _stream_message_for,
+    _stream_subscribe,
+    _stream_unsubscribe,
+    app as flask_app,
+)
+
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", "16") or "16")
+# Response chunks buffered per request before the pool thread waits for the client.
+ASGI_SEND_QUEUE = 8
+
+_STREAM_PATH = re.compile(r"/api/event/(\d+)/stream")
+_STREAM_ROUTE = "/api/event/<int:event_id>/stream"
+_wsgi = WSGIMiddleware(flask_app, workers=ASGI_THREADS, send_queue_size=ASGI_SEND_QUEUE)
+# Stream snapshots share the WSGI pool, so ASGI_THREADS bounds every thread touching the database.
+_pool = _wsgi.executor
+
+
+class _LoopQueue:
+    """Broadcaster-side `put` that hands messages to an asyncio.Queue on the loop thread."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, message: dict) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+
+def _open_stream(event_id: int, session_id: int | None, since: int | None) -> dict | None:
+    if not _get_event(event_id):
+        return None
+    with _event_scope(event_id), _db() as conn:
+        return _live_snapshot(conn, event_id, session_id=session_id, since=since)
+
+
+def _catch_up(event_id: int, session_id: int, cursor: int) -> dict | None:
+    with _event_scope(event_id), _db() as conn:
+        return _live_snapshot(conn, event_id, session_id=session_id, since=cursor)
+
+
+async def _wait_disconnect(receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _event_stream(scope: dict, receive, send, event_id: int) -> None:
+    """Async twin of app._live_stream: same events, ids and keepalives, no thread held."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    session_id, since = _parse_stream_id(headers.get("last-event-id"))
+    subscriber = _LoopQueue(loop)
+    # Subscribe before the first snapshot so no commit can fall between the two.
+    _stream_subscribe(event_id, subscriber)
+    try:
+        payload = await loop.run_in_executor(_pool, _open_stream, event_id, session_id, since)
+        if payload is None:
+            # Unknown event: let Flask send its usual 404.
+            _stream_unsubscribe(event_id, subscriber)
+            await _wsgi(scope, receive, send)
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-store"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        labels = (("route", _STREAM_ROUTE), ("method", scope["method"]))
+        _metric_inc("attendance_http_requests_total", (*labels, ("status", "200")))
+        _metric_observe("attendance_http_request_duration_seconds", time.perf_counter() - started, labels)
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        await send({"type": "http.response.body", "body": f"retry: 3000\n{_sse(payload)}".encode(), "more_body": True})
+        session_id, cursor = payload["session_id"], payload["cursor"]
+        disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            deadline = loop.time() + STREAM_MAX_SECONDS
+            while loop.time() < deadline:
+                get = asyncio.ensure_future(subscriber.queue.get())
+                done, _ = await asyncio.wait(
+                    {get, disconnect},
+                    timeout=min(STREAM_KEEPALIVE_SECONDS, max(deadline - loop.time(), 0)),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if get not in done:
+                    get.cancel()
+                    if disconnect in done:
+                        return
+                    await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                    continue
+
+                message = _stream_message_for(get.result(), session_id=session_id, cursor=cursor)
+                if message is None:
+                    message = await loop.run_in_executor(_pool, _catch_up, event_id, session_id, cursor)
+                    if message is None:
+                        break
+                session_id, cursor = message["session_id"], message["cursor"]
+                await send({"type": "http.response.body", "body": _sse(message).encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            pass  # client went away while we were writing
+        finally:
+            disconnect.cancel()
+    finally:
+        _stream_unsubscribe(event_id, subscriber)
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            _pool.shutdown(wait=False, cancel_futures=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope: dict, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    match = _STREAM_PATH.fullmatch(scope["path"])
+    if match and scope["method"] in ("GET", "HEAD"):
+        await _event_stream(scope, receive, send, int(match.group(1)))
+    else:
+        await _wsgi(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("asgi:app", host="0.0.0.0", port=int(os.environ.get("PORT", "5000") or "5000"))
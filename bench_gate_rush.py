@@ -0,0 +1,345 @@
+"""Gate-rush load benchmark for the attendance server.
+
+Seeds a fresh SQLite database with a synthetic roster, then simulates N scanner devices
+hitting /mark (valid, duplicate and invalid UIDs) while polling /stats and
+/api/event/<id>/session, plus admin browsers polling /admin/api/dashboard.
+
+Runs against the app in-process (Flask test client, no network) or under a local
+gunicorn started on a free port, and prints one JSON report so runs can be diffed
+between commits:
+
+    python bench_gate_rush.py --mode inprocess --devices 20 --duration 30
+    python bench_gate_rush.py --mode gunicorn --workers 2 --threads 16 --output before.json
+"""
+
+import argparse
+import csv
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADMIN_PASSWORD = "bench"
+EVENT_ID = 1
+
+
+def _parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--mode", choices=("inprocess", "gunicorn"), default="inprocess")
+    p.add_argument("--roster", type=int, default=20000, help="Students in the synthetic event.")
+    p.add_argument("--devices", type=int, default=20, help="Concurrent scanner devices.")
+    p.add_argument("--admins", type=int, default=2, help="Concurrent admin dashboards.")
+    p.add_argument("--duration", type=float, default=20.0, help="Seconds of load.")
+    p.add_argument("--think-ms", type=float, default=50.0, help="Pause between a device's scans.")
+    p.add_argument("--poll-every", type=int, default=10, help="Device polls /stats + /session every N scans.")
+    p.add_argument("--admin-poll-ms", type=float, default=1000.0)
+    p.add_argument("--duplicate", type=float, default=0.15, help="Share of scans that repeat a marked UID.")
+    p.add_argument("--invalid", type=float, default=0.05, help="Share of scans with an unknown UID.")
+    p.add_argument("--workers", type=int, default=2, help="gunicorn --workers")
+    p.add_argument("--threads", type=int, default=4, help="gunicorn --threads")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    return p.parse_args()
+
+
+class InProcessClient:
+    def __init__(self, flask_app):
+        self._client = flask_app.test_client()
+
+    def request(self, method: str, path: str, *, json_body=None, form=None) -> tuple[int, bytes]:
+        resp = self._client.open(path, method=method, json=json_body, data=form)
+        return resp.status_code, resp.get_data()
+
+
+class HttpClient:
+    """Keep-alive HTTP/1.1 client for one thread, with a minimal cookie jar."""
+
+    def __init__(self, port: int):
+        self._port = port
+        self._conn: http.client.HTTPConnection | None = None
+        self._cookie = ""
+
+    def request(self, method: str, path: str, *, json_body=None, form=None) -> tuple[int, bytes]:
+        headers = {"Cookie": self._cookie} if self._cookie else {}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers["Content-Type"] = "application/json"
+        elif form is not None:
+            body = urllib.parse.urlencode(form).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection("127.0.0.1", self._port, timeout=60)
+            try:
+                self._conn.request(method, path, body=body, headers=headers)
+                resp = self._conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError):
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+                continue
+            cookie = resp.getheader("Set-Cookie")
+            if cookie:
+                self._cookie = cookie.split(";", 1)[0]
+            return resp.status, data
+        raise RuntimeError("unreachable")
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.statuses: dict[str, Counter] = defaultdict(Counter)
+
+    def timed(self, name: str, client, method: str, path: str, **kwargs) -> tuple[int, bytes]:
+        t0 = time.perf_counter()
+        try:
+            status, body = client.request(method, path, **kwargs)
+        except Exception:
+            status, body = 599, b""
+        elapsed = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            self.latencies[name].append(elapsed)
+            self.statuses[name][status] += 1
+        return status, body
+
+
+class UidPool:
+    """Hands out never-scanned roster UIDs; remembers marked ones for duplicate scans."""
+
+    def __init__(self, uids: list[str], rng: random.Random):
+        self._lock = threading.Lock()
+        self._fresh = list(uids)
+        rng.shuffle(self._fresh)
+        self._marked: list[str] = []
+
+    def pick(self, rng: random.Random, duplicate: float, invalid: float) -> str:
+        roll = rng.random()
+        with self._lock:
+            if roll < invalid:
+                return f"NOPE-{rng.randrange(10**9)}"
+            if (roll < invalid + duplicate or not self._fresh) and self._marked:
+                return rng.choice(self._marked)
+            if not self._fresh:
+                return f"NOPE-{rng.randrange(10**9)}"
+            uid = self._fresh.pop()
+            self._marked.append(uid)
+            return uid
+
+
+class BusyCounter(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        text = record.getMessage()
+        if record.exc_info and record.exc_info[1] is not None:
+            text += str(record.exc_info[1])
+        if "database is locked" in text or "database is busy" in text:
+            self.count += 1
+
+
+def _roster_csv(count: int) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["UID", "Name", "Branch", "Year"])
+    for i in range(count):
+        writer.writerow([f"B{i:07d}", f"Student {i}", random.choice(["CSE", "ECE", "ME", "CE"]), 1 + i % 4])
+    return buf.getvalue().encode()
+
+
+def _seed(flask_app, roster: int) -> list[str]:
+    client = flask_app.test_client()
+    client.post("/admin/login", data={"username": "admin", "password": ADMIN_PASSWORD})
+    resp = client.post(
+        "/admin/api/import",
+        data={"event_id": str(EVENT_ID), "file": (io.BytesIO(_roster_csv(roster)), "roster.csv")},
+        content_type="multipart/form-data",
+    )
+    if resp.status_code != 200:
+        raise SystemExit(f"Seeding failed: {resp.status_code} {resp.get_data(as_text=True)[:200]}")
+    return [f"B{i:07d}" for i in range(roster)]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_gunicorn(args: argparse.Namespace, env: dict, log_path: str) -> tuple[subprocess.Popen, int]:
+    port = _free_port()
+    cmd = [
+        sys.executable, "-m", "gunicorn", "wsgi:app",
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(args.workers),
+        "--threads", str(args.threads),
+        "--timeout", "120",
+    ]
+    log = open(log_path, "w")
+    proc = subprocess.Popen(cmd, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"gunicorn exited early, see {log_path}")
+        try:
+            status, _ = HttpClient(port).request("GET", "/events")
+            if status == 200:
+                return proc, port
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("gunicorn did not come up within 30s")
+
+
+def _device(idx: int, client, rec: Recorder, pool: UidPool, args, stop_at: float) -> None:
+    rng = random.Random(args.seed * 1000 + idx)
+    device_id = f"bench-{idx:03d}"
+    scans = 0
+    while time.monotonic() < stop_at:
+        uid = pool.pick(rng, args.duplicate, args.invalid)
+        rec.timed(
+            "mark", client, "POST", "/mark",
+            json_body={"uid": uid, "event_id": EVENT_ID, "device_id": device_id, "device_timestamp": ""},
+        )
+        scans += 1
+        if scans % max(args.poll_every, 1) == 0:
+            rec.timed("stats", client, "GET", f"/stats?event_id={EVENT_ID}&device_id={device_id}")
+            rec.timed("session", client, "GET", f"/api/event/{EVENT_ID}/session")
+        if args.think_ms > 0:
+            time.sleep(args.think_ms / 1000)
+
+
+def _admin(client, rec: Recorder, args, stop_at: float) -> None:
+    client.request("POST", "/admin/login", form={"username": "admin", "password": ADMIN_PASSWORD})
+    cursor = None
+    while time.monotonic() < stop_at:
+        since = f"&since={cursor}" if cursor is not None else ""
+        status, body = rec.timed("dashboard", client, "GET", f"/admin/api/dashboard?event_id={EVENT_ID}{since}")
+        if status == 200:
+            cursor = json.loads(body).get("cursor", cursor)
+        time.sleep(args.admin_poll_ms / 1000)
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return round(sorted_values[k], 2)
+
+
+def _report(args, rec: Recorder, elapsed: float, busy: int) -> dict:
+    endpoints = {}
+    total = errors = 0
+    for name in sorted(rec.latencies):
+        values = sorted(rec.latencies[name])
+        statuses = rec.statuses[name]
+        count = len(values)
+        server_errors = sum(n for code, n in statuses.items() if code >= 500)
+        total += count
+        errors += server_errors
+        endpoints[name] = {
+            "requests": count,
+            "rps": round(count / elapsed, 1),
+            "p50_ms": _percentile(values, 50),
+            "p95_ms": _percentile(values, 95),
+            "p99_ms": _percentile(values, 99),
+            "max_ms": round(values[-1], 2) if values else 0.0,
+            "status": {str(code): n for code, n in sorted(statuses.items())},
+            "error_5xx_rate": round(server_errors / count, 5) if count else 0.0,
+        }
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = ""
+    return {
+        "commit": commit,
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "elapsed_s": round(elapsed, 2),
+        "totals": {
+            "requests": total,
+            "throughput_rps": round(total / elapsed, 1),
+            "error_5xx": errors,
+            "error_5xx_rate": round(errors / total, 5) if total else 0.0,
+            "sqlite_busy": busy,
+            "sqlite_busy_rate": round(busy / total, 5) if total else 0.0,
+        },
+        "endpoints": endpoints,
+    }
+
+
+def main() -> None:
+    args = _parse_args()
+    workdir = tempfile.mkdtemp(prefix="bench_gate_rush_")
+    env = dict(os.environ, DB_PATH=os.path.join(workdir, "bench.db"), ADMIN_PASSWORD=ADMIN_PASSWORD)
+    os.environ.update(env)
+
+    sys.path.insert(0, HERE)
+    import app as attendance_app
+
+    uids = _seed(attendance_app.app, args.roster)
+    busy = BusyCounter()
+    attendance_app.app.logger.addHandler(busy)
+
+    proc = None
+    log_path = os.path.join(workdir, "gunicorn.log")
+    if args.mode == "gunicorn":
+        attendance_app._close_db()
+        proc, port = _start_gunicorn(args, env, log_path)
+
+        def make_client():
+            return HttpClient(port)
+    else:
+
+        def make_client():
+            return InProcessClient(attendance_app.app)
+
+    rec = Recorder()
+    pool = UidPool(uids, random.Random(args.seed))
+    started = time.monotonic()
+    stop_at = started + args.duration
+    threads = [
+        threading.Thread(target=_device, args=(i, make_client(), rec, pool, args, stop_at), daemon=True)
+        for i in range(args.devices)
+    ] + [threading.Thread(target=_admin, args=(make_client(), rec, args, stop_at), daemon=True) for _ in range(args.admins)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    busy_count = busy.count
+    if proc is not None:
+        proc.terminate()
+        proc.wait(timeout=30)
+        with open(log_path, errors="replace") as f:
+            log_text = f.read()
+        busy_count = log_text.count("database is locked") + log_text.count("database is busy")
+
+    report = json.dumps(_report(args, rec, elapsed, busy_count), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""EXPLAIN QUERY PLAN checks for app.HOT_QUERIES against a freshly migrated database.
+
+Run with `python -m pytest tests`. Importing app runs init_db(), so DB_PATH has to point
+at a throwaway file before the import.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "attendance.db")
+os.environ["EVENT_SHARDS"] = "0"
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+# Module-level *_SQL statements that are not request-path queries.
+NOT_HOT = {
+    "_COMPUTED_COUNTERS_SQL",  # full recount for rebuild/verify; scans by design
+}
+
+
+def test_schema_is_fully_migrated():
+    with app._db() as conn:
+        assert app._schema_version(conn) == len(app.MIGRATIONS)
+
+
+def test_hot_queries_use_indexes():
+    with app._db() as conn:
+        assert app._query_plan_scans(conn) == []
+
+
+def test_every_sql_constant_is_a_hot_query():
+    checked = {sql for _, sql in app.HOT_QUERIES}
+    constants = {
+        name: value
+        for name, value in vars(app).items()
+        if name.endswith("_SQL") and isinstance(value, str) and name not in NOT_HOT
+    }
+    assert constants
+    assert sorted(name for name, sql in constants.items() if sql not in checked) == []
+
+
+def test_hot_query_names_are_unique():
+    names = [name for name, _ in app.HOT_QUERIES]
+    assert len(names) == len(set(names))
+
+
+def test_full_scan_allowances_name_hot_queries():
+    names = {name for name, _ in app.HOT_QUERIES}
+    assert sorted(set(app.FULL_SCAN_QUERIES) - names) == []
+
+
+def test_check_query_plans_with_event_shards(tmp_path):
+    # Sharded layout: students/sessions tables live in a per-event file attached to the catalog.
+    env = {**os.environ, "DB_PATH": str(tmp_path / "attendance.db"), "EVENT_SHARDS": "1"}
+    result = subprocess.run(
+        [sys.executable, "-m", "flask", "--app", "app", "check-query-plans"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert f"All {len(app.HOT_QUERIES)} hot queries use indexes." in result.stdout